@@ -1,15 +1,20 @@
 import os
+import sys
+import numpy as np
 import pandas as pd
-from torchvision.io import read_image
+from torchvision.io import read_image, ImageReadMode
+from torchvision.transforms.functional import resize
 import torch
 from torch.utils.data import Dataset
 import matplotlib.pyplot as plt
 import json
+from tqdm import tqdm
 
 
 class FaceDataset(Dataset):
-    def __init__(self, annotations_file, img_dir, device=None, transform=None, target_transform=None):
-        self.img_labels = pd.read_csv(annotations_file)
+    def __init__(self, annotations_file, img_dir, device=None, transform=None, target_transform=None, indices=None):
+        # indices (array or .npy index file) selects a subset of the rows of the annotations file
+        self.img_labels = subset_view(pd.read_csv(annotations_file), indices)
         self.img_dir = img_dir
         self.device = device
         self.transform = transform
@@ -32,40 +37,120 @@ class FaceDataset(Dataset):
         return image, label
 
 
-def split_dataset(face_dataset: FaceDataset, train_split: float):
-    df: pd.DataFrame = face_dataset.img_labels
+def pack_images(annotation_files, img_dir, out_prefix, image_size=224):
+    # decodes every image listed in the annotation files once into a uint8 NHWC memory-mapped array
+    # (<out_prefix>_images.npy) plus an index file mapping file names to rows (<out_prefix>_index.csv)
+    files = pd.unique(pd.concat([pd.read_csv(fn)['file'] for fn in annotation_files]))
+    images = np.lib.format.open_memmap(out_prefix + '_images.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(files), image_size, image_size, 3))
+    for row, file in enumerate(tqdm(files)):
+        image = read_image(os.path.join(img_dir, file), mode=ImageReadMode.RGB)
+        if image.shape[1:] != (image_size, image_size):
+            image = resize(image, [image_size, image_size], antialias=True)
+        images[row] = image.permute(1, 2, 0).numpy()
+    images.flush()
+    # the index is written last, so its existence marks a complete pack
+    pd.DataFrame({'file': files, 'row': np.arange(len(files))}).to_csv(out_prefix + '_index.csv', index=False)
 
-    df_grouped = df.groupby(['service_test', 'gender', 'race'])
 
-    train_set = []
-    for name, group in df_grouped:
-        random_set = group.sample(frac=train_split)
-        train_set.append(random_set)
+# Subsets are integer row indices over one master label table (e.g. fairface_label_train.csv), built from boolean
+# masks and stored as compact .npy index files instead of new csv files. FaceDataset(master, ..., indices=file)
+# then only selects these rows of the master table.
+def load_indices(indices):
+    if isinstance(indices, str):
+        return np.load(indices)
+    return np.asarray(indices)
 
-    df_train = pd.concat(train_set)
-    df_val = pd.concat([df, df_train]).drop_duplicates(keep=False)
 
-    df_train.to_csv('./train.csv', index=False)
-    df_val.to_csv('./val.csv', index=False)
+def save_indices(indices, fn: str):
+    # boolean masks are stored as the indices of their true rows
+    indices = np.asarray(indices)
+    if indices.dtype == bool:
+        indices = np.flatnonzero(indices)
+    np.save(fn, indices.astype(np.int32))
 
 
-def split_based_on_service_test(face_dataset: FaceDataset, service_test = True, fn='test'):
-    df: pd.DataFrame = face_dataset.img_labels
+def subset_view(df: pd.DataFrame, indices=None):
+    if indices is None:
+        return df
+    return df.iloc[load_indices(indices)]
+
+
+def random_group_ranks(df: pd.DataFrame, by, rng):
+    # group number and group size of every row and its rank in a random order within its group
+    groups = df.groupby(list(by), sort=True).ngroup().to_numpy()
+    counts = np.bincount(groups)
+    order = np.lexsort((rng.random(len(groups)), groups))
+    rank = np.empty(len(groups), dtype=np.int64)
+    rank[order] = np.arange(len(groups)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return groups, counts, rank
+
+
+def stratified_indices(df: pd.DataFrame, fraction: float, by=('service_test', 'gender', 'race'), seed=None):
+    # splits the rows into (first, rest) index arrays, first holds round(fraction * n) random rows of every group
+    rng = np.random.default_rng(seed)
+    groups, counts, rank = random_group_ranks(df, by, rng)
+    mask = rank < np.round(counts * fraction).astype(np.int64)[groups]
+    return np.flatnonzero(mask), np.flatnonzero(~mask)
+
+
+def service_test_mask(df: pd.DataFrame, service_test: bool = True):
+    return (df['service_test'] == service_test).to_numpy()
+
 
-    df_grouped = df.groupby(['service_test'])
+def unbalanced_mask(df: pd.DataFrame, service_test: bool, race: str):
+    # service_test rows of all other races plus the non service_test rows of race (the rows in exactly one of both)
+    return service_test_mask(df, service_test) ^ (df['race'] == race).to_numpy()
 
-    for service_test_bool, group in df_grouped:
-        group.to_csv(f'./{fn}_{service_test_bool}.csv', index=False)
 
+def allocate(counts: np.array, total: int):
+    # largest remainder allocation of total over groups proportional to counts (never more than a group has)
+    quota = counts * total / counts.sum()
+    allocation = np.floor(quota).astype(np.int64)
+    remaining = total - allocation.sum()
+    allocation[np.argsort(allocation - quota, kind='stable')[:remaining]] += 1
+    return np.minimum(allocation, counts)
 
-def create_unbalanced_dataset(face_dataset: FaceDataset, service_test: bool, race: str, fn: str):
+
+def sample_indices(df: pd.DataFrame, size: int = None, fraction: float = None,
+                   by=('race', 'gender', 'service_test'), seed=None):
+    # sorted indices of a random subset of size rows (or fraction of all rows) with the group proportions of df
+    rng = np.random.default_rng(seed)
+    if size is None:
+        size = int(round(fraction * len(df)))
+    groups, counts, rank = random_group_ranks(df, by, rng)
+    return np.flatnonzero(rank < allocate(counts, min(size, len(df)))[groups])
+
+
+def split_dataset(face_dataset: FaceDataset, train_split: float, seed=None, fn=('train', 'val'), write_csv=False):
+    df: pd.DataFrame = face_dataset.img_labels
+
+    train_idx, val_idx = stratified_indices(df, train_split, seed=seed)
+    save_indices(train_idx, f'./{fn[0]}_idx.npy')
+    save_indices(val_idx, f'./{fn[1]}_idx.npy')
+    if write_csv:
+        df.iloc[train_idx].to_csv(f'./{fn[0]}.csv', index=False)
+        df.iloc[val_idx].to_csv(f'./{fn[1]}.csv', index=False)
+    return train_idx, val_idx
+
+
+def split_based_on_service_test(face_dataset: FaceDataset, service_test = True, fn='test', write_csv=False):
     df: pd.DataFrame = face_dataset.img_labels
 
-    df_true = df[df['service_test'] == service_test]
-    df_race = df[df['race'] == race]
-    df_true_and_one_race = pd.concat([df_true, df_race]).drop_duplicates(keep=False)
+    for service_test_bool in [True, False]:
+        mask = service_test_mask(df, service_test_bool)
+        save_indices(mask, f'./{fn}_{service_test_bool}_idx.npy')
+        if write_csv:
+            df[mask].to_csv(f'./{fn}_{service_test_bool}.csv', index=False)
+
+
+def create_unbalanced_dataset(face_dataset: FaceDataset, service_test: bool, race: str, fn: str, write_csv=False):
+    df: pd.DataFrame = face_dataset.img_labels
 
-    df_true_and_one_race.to_csv(f'./{fn}_{service_test}_{race}.csv', index=False)
+    mask = unbalanced_mask(df, service_test, race)
+    save_indices(mask, f'./{fn}_{service_test}_{race}_idx.npy')
+    if write_csv:
+        df[mask].to_csv(f'./{fn}_{service_test}_{race}.csv', index=False)
 
 
 def dataset_balance(face_dataset: FaceDataset):
@@ -114,7 +199,75 @@ def save_images_number(face_dataset: FaceDataset):
         json.dump(n_images, f)
 
 
-if __name__ == '__main__':
+def pack_subset(files, packed_prefix: str, out_prefix: str, chunk_size: int = 1024):
+    # copies the images of files out of an existing pack (no jpeg decoding), in the row order of the source
+    index = pd.read_csv(packed_prefix + '_index.csv', index_col='file')['row']
+    rows = index.loc[files].to_numpy()
+    order = np.argsort(rows)
+    files, rows = np.asarray(files)[order], rows[order]
+    source = np.load(packed_prefix + '_images.npy', mmap_mode='r')
+    images = np.lib.format.open_memmap(out_prefix + '_images.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(rows), *source.shape[1:]))
+    for start in tqdm(range(0, len(rows), chunk_size)):
+        images[start:start + chunk_size] = source[rows[start:start + chunk_size]]
+    images.flush()
+    pd.DataFrame({'file': files, 'row': np.arange(len(files))}).to_csv(out_prefix + '_index.csv', index=False)
+
+
+def make_short_version(data_path: str, size: int = None, fraction: float = None, seed: int = 0,
+                       sources=(('train.csv', 'short_version_fairface_label_train.csv'),
+                                ('val.csv', 'short_version_fairface_label_val.csv')),
+                       test_file: str = 'test.csv'):
+    # writes the short_version_* annotation files dlds_code uses with use_short_data_version. Every split is
+    # subsampled with the race x gender x service_test proportions of the full split, either to fraction of its rows
+    # or, with size, the first (train) split to size rows and the other splits to the same fraction of rows, which
+    # keeps the original val/train ratio. The same seed gives the same subset. The images of the short splits and of
+    # the (full) test split are packed into <data_path>/short_version_packed, copied from <data_path>/packed when
+    # that exists
+    files = []
+    n_first = None
+    for source, target in sources:
+        df = pd.read_csv(os.path.join(data_path, source))
+        if n_first is None:
+            n_first = len(df)
+        split_size = None if size is None else max(1, round(size * len(df) / n_first))
+        short = df.iloc[sample_indices(df, split_size, fraction, seed=seed)]
+        short.to_csv(os.path.join(data_path, target), index=False)
+        files.append(short['file'])
+        print(f'{target}: {len(short)} of {len(df)} rows')
+    files.append(pd.read_csv(os.path.join(data_path, test_file))['file'])
+    files = pd.unique(pd.concat(files))
+
+    packed_prefix = os.path.join(data_path, 'packed')
+    out_prefix = os.path.join(data_path, 'short_version_packed')
+    if os.path.isfile(packed_prefix + '_index.csv'):
+        pack_subset(files, packed_prefix, out_prefix)
+    else:
+        pack_images([os.path.join(data_path, target) for _, target in sources] + [os.path.join(data_path, test_file)],
+                    data_path, out_prefix)
+
+
+def main_short(data_path, amount, seed=0):
+    # usage: python dataloader.py short <data_path> <size or fraction> [seed]
+    # a size is the number of train rows, val is scaled by the original val/train ratio
+    amount = float(amount)
+    if amount < 1:
+        make_short_version(data_path, fraction=amount, seed=int(seed))
+    else:
+        make_short_version(data_path, size=int(amount), seed=int(seed))
+
+
+def main_pack(data_path):
+    # usage: python dataloader.py pack <data_path>
+    annotation_files = [os.path.join(data_path, fn) for fn in ['train.csv', 'val.csv', 'test.csv']]
+    pack_images(annotation_files, data_path, os.path.join(data_path, 'packed'))
+
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'pack':
+    main_pack(sys.argv[2] if len(sys.argv) > 2 else 'DD2424_data')
+elif __name__ == '__main__' and len(sys.argv) > 3 and sys.argv[1] == 'short':
+    main_short(*sys.argv[2:5])
+elif __name__ == '__main__':
     # training_data = FaceDataset('./fairface_label_train.csv', '.')
     #
     # split_dataset(training_data, 0.875)
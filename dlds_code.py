@@ -23,11 +23,22 @@ from tqdm.notebook import tqdm
 import torchvision
 import torchvision.transforms as transforms
 import datetime
+import collections
+import queue
+import random
+import threading
+import multiprocessing
+import runpy
+import contextlib
+import copy
 import sys
 import yaml
+import json
 import optuna
 import numpy as np
-import pickle as pkl
+from dataloader import pack_images, subset_view
+from prediction_store import PredictionWriter, STORE_SUFFIX, split_hash
+from prediction_analysis import attention_scores
 
 def np_to_tensor(x, device):
     # allocates tensors from np.arrays
@@ -36,61 +47,225 @@ def np_to_tensor(x, device):
     else:
         return torch.from_numpy(x).contiguous().pin_memory().to(device=device, non_blocking=True)
 
+GENDER_NAMES = ['Male', 'Female']
+RACE_NAMES = ['Black', 'East Asian', 'Indian', 'Latino_Hispanic', 'Middle Eastern', 'Southeast Asian', 'White']
+AGE_NAMES = ['0-2', '3-9', '10-19', '20-29', '30-39', '40-49', '50-59', '60-69', 'more than 70']
+LABEL_NAMES = {'gender': GENDER_NAMES, 'race': RACE_NAMES, 'age': AGE_NAMES}
+
+def encode_one_hot(values, names):
+    # encodes a whole column of class names at once into a contiguous one-hot float tensor
+    codes = pd.Categorical(values, categories=names).codes.astype(np.int64)
+    if (codes < 0).any():
+        print("Problem: label not known for indices " + str(np.flatnonzero(codes < 0).tolist()))
+        codes[codes < 0] = 0
+    return torch.nn.functional.one_hot(torch.from_numpy(codes), num_classes=len(names)).float().contiguous()
+
+def collate_batched(batch):
+    # FaceDataset.__getitems__ already returns a whole batch, only per-sample lists need the default collation
+    if isinstance(batch, list):
+        return torch.utils.data.default_collate(batch)
+    return batch
+
 class FaceDataset(Dataset):
-    def __init__(self, annotations_file, img_dir, transform=None, target_transform=None, output_category="gender", balanced=False):
-        self.img_labels = pd.read_csv(annotations_file)
+    def __init__(self, annotations_file, img_dir, transform=None, target_transform=None, output_category="gender", balanced=False, additional_heads=[], indices=None):
+        # indices (array or .npy index file from dataloader) selects a subset of the rows of the annotations file
+        self.img_labels = subset_view(pd.read_csv(annotations_file), indices)
+        self.annotations_file = annotations_file
+        # the index file (if any) is part of the split's identity, several splits can share one annotations file
+        self.indices_file = indices if isinstance(indices, str) else None
+        self.balanced = balanced
         if balanced:
             df: pd.DataFrame = self.img_labels
             self.img_labels = df[df['service_test']]
+        # ties prediction files to the ground truth of this split
+        self.split_hash = split_hash(self.img_labels['file'])
         self.img_dir = img_dir
         self.transform = transform
         self.target_transform = target_transform
         self.output_category = output_category
+        if output_category == "gender":
+            self.head_names = ['gender']
+        elif output_category == "race":
+            self.head_names = ['race']
+        elif output_category == "combined":
+            self.head_names = ['race', 'gender'] + list(additional_heads)
+        else:
+            print("no valid output_category")
+        # all labels are encoded once here, __getitem__ only indexes into these tensors
+        self.labels = {name: encode_one_hot(self.img_labels[name], names) for name, names in LABEL_NAMES.items()}
 
     def __len__(self):
         return len(self.img_labels)
 
-    def __getitem__(self, idx):
+    def load_image(self, idx):
         img_path = os.path.join(self.img_dir, self.img_labels.iloc[idx, 0])
-        image = (read_image(img_path)/255).to(device=device, non_blocking=True)
-        if self.output_category == "gender" or self.output_category == "combined":
-            label = torch.tensor(int(self.img_labels.iloc[idx, 2] == 'Female'))
-            gender_label = torch.nn.functional.one_hot(label, num_classes=2)
-        if self.output_category == "race" or self.output_category == "combined":
-            ethnicity = self.img_labels.iloc[idx, 3]
-            label = 0
-            if ethnicity == 'Black':
-                label = 0
-            elif ethnicity == "East Asian":
-                label = 1
-            elif ethnicity == "Indian":
-                label = 2
-            elif ethnicity == "Latino_Hispanic":
-                label = 3
-            elif ethnicity == "Middle Eastern":
-                label = 4
-            elif ethnicity == "Southeast Asian":
-                label = 5
-            elif ethnicity == "White":
-                label = 6
-            else:
-                print("Problem: ethnicity label not known for index " + str(idx))
-            label = torch.tensor(label)
-            ethnicity_label = torch.nn.functional.one_hot(label, num_classes=7)
-        if(self.output_category == "gender"):
-            label=gender_label.float().to(device=device, non_blocking=True)
-        elif(self.output_category == "race"):
-            label = ethnicity_label.float().to(device=device, non_blocking=True)
-        elif (self.output_category == "combined"):
-            label = (ethnicity_label.float().to(device=device, non_blocking=True), gender_label.float().to(device=device, non_blocking=True))
-        else:
-            print("no valid output_category")
+        return read_image(img_path)/255
+
+    def load_images(self, indices):
+        return torch.stack([self.load_image(idx) for idx in indices])
+
+    def get_label(self, idx):
+        # idx can be a single index or a tensor of indices
+        if self.output_category == "combined":
+            return tuple(self.labels[name][idx] for name in self.head_names)
+        return self.labels[self.head_names[0]][idx]
+
+    def __getitem__(self, idx):
+        # everything stays on the cpu so that items can be loaded in DataLoader worker processes,
+        # batches are moved to the device by DevicePrefetcher
+        image = self.load_image(idx)
+        label = self.get_label(idx)
         if self.transform:
             image = self.transform(image)
         if self.target_transform:
             label = self.target_transform(label)
         return image, label
 
+    def __getitems__(self, indices):
+        # batched path used by the DataLoader, returns an already collated (images, labels) batch
+        if self.transform or self.target_transform:
+            return [self[idx] for idx in indices]
+        return self.load_images(indices), self.get_label(torch.as_tensor(indices))
+
+class PackedFaceDataset(FaceDataset):
+    # serves images from the memory-mapped array written by dataloader.pack_images instead of decoding the jpegs
+    def __init__(self, annotations_file, img_dir, packed_prefix, **kwargs):
+        super().__init__(annotations_file, img_dir, **kwargs)
+        self.packed_prefix = packed_prefix
+        index = pd.read_csv(packed_prefix + '_index.csv', index_col='file')['row']
+        self.rows = index.loc[self.img_labels['file']].to_numpy()
+        self.images = None
+
+    def load_image(self, idx):
+        # the array is opened lazily so that every DataLoader worker maps it itself instead of pickling it
+        if self.images is None:
+            self.images = np.load(self.packed_prefix + '_images.npy', mmap_mode='c')
+        image = torch.from_numpy(self.images[self.rows[idx]])  # zero-copy view into the memory map
+        return image.permute(2, 0, 1)/255
+
+    def load_images(self, indices):
+        if self.images is None:
+            self.load_image(indices[0])
+        images = torch.from_numpy(self.images[self.rows[np.asarray(indices)]])
+        return images.permute(0, 3, 1, 2)/255
+
+def batch_to_device(batch, device):
+    # moves (possibly nested tuples of) tensors to the device without blocking the host
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(batch_to_device(el, device) for el in batch)
+    return batch.to(device=device, non_blocking=True)
+
+def record_stream(batch, stream):
+    # marks (possibly nested tuples or lists of) tensors as used on the stream, like batch_to_device walks them
+    if isinstance(batch, (tuple, list)):
+        for el in batch:
+            record_stream(el, stream)
+    else:
+        batch.record_stream(stream)
+
+class DevicePrefetcher:
+    # wraps a DataLoader and copies the next `depth` batches to the device while the current batch is used
+    def __init__(self, dataloader, device, depth=2):
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = depth
+        self.stream = torch.cuda.Stream() if str(device).startswith('cuda') else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _copy(self, batch):
+        if self.stream is None:
+            return batch_to_device(batch, self.device)
+        with torch.cuda.stream(self.stream):
+            return batch_to_device(batch, self.device)
+
+    def _ready(self, batch):
+        if self.stream is not None:
+            # make the compute stream wait for the copy and keep the memory alive until it has been used
+            torch.cuda.current_stream().wait_stream(self.stream)
+            record_stream(batch, torch.cuda.current_stream())
+        return batch
+
+    def __iter__(self):
+        queue = collections.deque()
+        for batch in self.dataloader:
+            queue.append(self._copy(batch))
+            if len(queue) > self.depth:
+                yield self._ready(queue.popleft())
+        while queue:
+            yield self._ready(queue.popleft())
+
+def dataset_groups(dataset, age_groups=False):
+    # race x gender group of every sample (2*race+gender), with age_groups (2*race+gender)*n_ages+age
+    groups = 2 * torch.argmax(dataset.labels['race'], dim=1) + torch.argmax(dataset.labels['gender'], dim=1)
+    if age_groups:
+        groups = groups * len(AGE_NAMES) + torch.argmax(dataset.labels['age'], dim=1)
+    return groups.numpy()
+
+class GroupBalancedSampler(torch.utils.data.Sampler):
+    # draws num_samples indices per epoch with replacement: first a group with probability proportional to
+    # group_weights (alias method, O(1) per draw), then a sample of that group uniformly. With equal group weights
+    # every group contributes the same share of each batch while all rows of the unbalanced dataset stay in use
+    def __init__(self, groups, group_weights, num_samples=None, seed=None):
+        self.num_samples = len(groups) if num_samples is None else num_samples
+        # samples sorted by group, group g owns order[starts[g]:starts[g]+counts[g]]
+        self.order = np.argsort(groups, kind='stable')
+        self.counts = np.bincount(groups, minlength=len(group_weights))
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+        weights = np.where(self.counts > 0, np.asarray(group_weights, dtype=np.float64), 0)
+        self.prob, self.alias = self.alias_table(weights / weights.sum())
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def alias_table(p):
+        # Vose's alias method: column i is taken with probability prob[i], otherwise its alias
+        k = len(p)
+        prob, alias = np.ones(k), np.arange(k)
+        scaled = p * k
+        small = [i for i in range(k) if scaled[i] < 1]
+        large = [i for i in range(k) if scaled[i] >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        return prob, alias
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        columns = self.rng.integers(0, len(self.prob), self.num_samples)
+        groups = np.where(self.rng.random(self.num_samples) < self.prob[columns], columns, self.alias[columns])
+        members = (self.rng.random(self.num_samples) * self.counts[groups]).astype(np.int64)
+        return iter(self.order[self.starts[groups] + members].tolist())
+
+def make_train_sampler(dataset):
+    # group weights from the group counts (every group equally likely) or from attention scores, the weight of a
+    # race x gender class is shared by its age groups
+    groups = dataset_groups(dataset, sampler_age_groups)
+    n_ages = len(AGE_NAMES) if sampler_age_groups else 1
+    if sampler_weights == 'counts':
+        group_weights = np.ones(14 * n_ages)
+    else:
+        group_weights = np.repeat(load_attention_weights(sampler_weights), n_ages)
+    if sampler_age_groups:
+        present = np.bincount(groups, minlength=14 * n_ages).reshape(14, n_ages) > 0
+        group_weights = group_weights / np.maximum(present.sum(axis=1), 1).repeat(n_ages)
+    return GroupBalancedSampler(groups, group_weights, epoch_length)
+
+def make_dataloader(dataset, batch_size, shuffle, sampler=None):
+    # decode, augmentation and collation run in worker processes into pinned memory, settings come from the config
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs = {'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers}
+    if sampler is not None:
+        shuffle = False
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler, collate_fn=collate_batched,
+                            num_workers=num_workers, pin_memory=(device == 'cuda'), **loader_kwargs)
+    return DevicePrefetcher(dataloader, device, prefetch_depth)
+
 def freeze_bn_module_params(module):
     if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
         for param in module.parameters():
@@ -100,28 +275,50 @@ def set_bn_estimate_to_eval(module):
     if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
         module.eval()
 
+# order in which torchvision's resnet applies its children, fc follows after flattening
+RESNET_STAGES = ['conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3', 'layer4', 'avgpool']
+
+# pretrained weights per depth, loaded once per process and reused by every model built afterwards
+pretrained_state_dicts = {}
+
+def pretrained_resnet(depth, pretrained=True):
+    constructors = {18: torchvision.models.resnet18, 34: torchvision.models.resnet34, 50: torchvision.models.resnet50}
+    if not pretrained:
+        # the weights are loaded from a checkpoint afterwards
+        return constructors[depth](pretrained=False)
+    if depth not in pretrained_state_dicts:
+        pretrained_state_dicts[depth] = constructors[depth](pretrained=True).state_dict()
+    net = constructors[depth](pretrained=False)
+    net.load_state_dict(pretrained_state_dicts[depth])
+    return net
+
 class FaceResNet(nn.Module):
-  def __init__(self, output_category, layers_to_train=[], train_bn_params=True, update_bn_estimate=True, depth=18):
+  def __init__(self, output_category, layers_to_train=[], train_bn_params=True, update_bn_estimate=True, depth=18, output_logits=False, pretrained=True):
         super().__init__()
+        self.output_category = output_category
+        # with output_logits the heads return logits (for BCE-with-logits, safe under autocast) instead of softmax outputs
+        self.output_logits = output_logits
+        self.channels_last = False
+        self.update_bn_estimate = update_bn_estimate
+        # index into RESNET_STAGES of the first stage forward applies, > 0 when training on cached features
+        self.input_stage = 0
         #load pretrained model
-        if depth==18:
-            self.net = torchvision.models.resnet18(pretrained=True)
-        elif depth==34:
-            self.net = torchvision.models.resnet34(pretrained=True)
-        elif depth==50:
-            self.net = torchvision.models.resnet50(pretrained=True)
+        if depth in [18, 34, 50]:
+            self.net = pretrained_resnet(depth, pretrained)
         else:
             print('depth choice not valid')
-        num_features=self.net.fc.in_features
+        self.num_features=self.net.fc.in_features
+        # names of the prediction heads, in the order the outputs are returned
+        self.head_names = []
         if(output_category=='combined'):
-            #build the two prediction heads for multi task learning
+            #build the two prediction heads for multi task learning, they share one backbone pass
             self.net.fc = nn.Identity()
-            self.net.fc_race = torch.nn.Sequential(torch.nn.Linear(in_features=num_features, out_features=7, bias=True), torch.nn.Softmax(dim=1))
-            self.net.fc_gender = torch.nn.Sequential(torch.nn.Linear(in_features=num_features, out_features=2, bias=True), torch.nn.Softmax(dim=1))
+            self.add_head('race', 7)
+            self.add_head('gender', 2)
         elif(output_category=='race'):
-            self.net.fc =torch.nn.Sequential(torch.nn.Linear(in_features=num_features, out_features=7, bias=True), torch.nn.Softmax(dim=1))
+            self.net.fc = self.make_head(7)
         elif(output_category=='gender'):
-            self.net.fc =torch.nn.Sequential(torch.nn.Linear(in_features=num_features, out_features=2, bias=True), torch.nn.Softmax(dim=1))
+            self.net.fc = self.make_head(2)
         else:
             print("no valid output category")
 
@@ -132,40 +329,205 @@ class FaceResNet(nn.Module):
             for l in layers_to_train:
                 for param in getattr(self.net, l).parameters():
                     param.requires_grad = True
-                if output_category=='combined':
-                    for param in self.net.fc_gender.parameters():
-                        param.requires_grad = True
-                    for param in self.net.fc_race.parameters():
-                        param.requires_grad = True
+            for name in self.head_names:
+                for param in self.get_head(name).parameters():
+                    param.requires_grad = True
         if not train_bn_params:
             self.net.apply(freeze_bn_module_params)
         if not update_bn_estimate:
             self.net.apply(set_bn_estimate_to_eval)
 
+  def add_head(self, name, num_classes):
+      # registers an additional prediction head (e.g. 'age') on top of the shared backbone features,
+      # its output is appended to the tuple returned by forward
+      if self.output_category != 'combined':
+          raise ValueError("Additional heads need output_category 'combined', got " + str(self.output_category))
+      if name in self.head_names:
+          raise ValueError("Head " + str(name) + " already exists")
+      head = self.make_head(num_classes)
+      setattr(self.net, 'fc_' + name, head)
+      self.head_names.append(name)
+      return head
+
+  def make_head(self, num_classes):
+      if self.output_logits:
+          return torch.nn.Sequential(torch.nn.Linear(in_features=self.num_features, out_features=num_classes, bias=True))
+      return torch.nn.Sequential(torch.nn.Linear(in_features=self.num_features, out_features=num_classes, bias=True), torch.nn.Softmax(dim=1))
+
+  def get_head(self, name):
+      return getattr(self.net, 'fc_' + name)
+
+  def use_channels_last(self):
+      # stores the weights in NHWC and converts every input to it in forward
+      self.channels_last = True
+      return self.to(memory_format=torch.channels_last)
+
+  def output_heads(self):
+      # names of the outputs of forward, in order
+      if self.output_category == 'combined':
+          return list(self.head_names)
+      return [self.output_category]
+
+  def to_probabilities(self, outputs):
+      # turns the outputs of forward into class probabilities, independent of output_logits
+      if not self.output_logits:
+          return outputs
+      if type(outputs) is tuple:
+          return tuple(torch.softmax(el.float(), dim=1) for el in outputs)
+      return torch.softmax(outputs.float(), dim=1)
+
+  def train(self, mode=True):
+      super().train(mode)
+      # model.train() would otherwise switch the batch norm layers back to updating their estimates
+      if not self.update_bn_estimate:
+          self.net.apply(set_bn_estimate_to_eval)
+      return self
+
+  def frozen_stages(self):
+      # number of leading RESNET_STAGES without trainable parameters, their output can be cached
+      for i, name in enumerate(RESNET_STAGES):
+          if any(param.requires_grad for param in getattr(self.net, name).parameters()):
+              return i
+      return len(RESNET_STAGES)
+
+  def prefix(self, x, n_stages):
+      for name in RESNET_STAGES[:n_stages]:
+          x = getattr(self.net, name)(x)
+      return x
+
+  def backbone(self, x):
+      # same as self.net(x), but starts at self.input_stage
+      if self.input_stage > 0:
+          x = x.float()
+      if self.channels_last and x.dim() == 4:
+          x = x.contiguous(memory_format=torch.channels_last)
+      for name in RESNET_STAGES[self.input_stage:]:
+          x = getattr(self.net, name)(x)
+      return self.net.fc(torch.flatten(x, 1))
+
   def forward(self, x):
-      if(output_category=='combined'):
-          gender_head = self.net.fc_gender(self.net(x))
-          ethnicity_head = self.net.fc_race(self.net(x))
-          return (ethnicity_head, gender_head)
+      if(self.output_category=='combined'):
+          # compute the backbone features once and feed them to every head
+          features = self.backbone(x)
+          return tuple(self.get_head(name)(features) for name in self.head_names)
       else:
-          return self.net(x)
+          return self.backbone(x)
+
+class CachedFeatureDataset(Dataset):
+    # serves the cached activations of the frozen stages of FaceResNet together with the labels of a FaceDataset
+    def __init__(self, dataset, features_file):
+        self.dataset = dataset
+        self.features_file = features_file
+        self.features = None
 
-def train(train_dataloader, eval_dataloader, model, loss_fn, metric_fns, optimizer, n_epochs, trial=None):
+    def __len__(self):
+        return len(self.dataset)
+
+    def load_features(self, indices):
+        if self.features is None:
+            self.features = np.load(self.features_file, mmap_mode='c')
+        return torch.from_numpy(self.features[indices])
+
+    def __getitem__(self, idx):
+        return self.load_features(idx), self.dataset.get_label(idx)
+
+    def __getitems__(self, indices):
+        return self.load_features(np.asarray(indices)), self.dataset.get_label(torch.as_tensor(indices))
+
+def build_feature_cache(model, dataset, n_stages, features_file, dtype=np.float16):
+    # runs the frozen prefix of the model once over the dataset and stores the activations memory-mapped. Like
+    # PredictionWriter, the temporary file is per process because parallel trials may build the same cache
+    tmp_file = features_file + '.' + str(os.getpid()) + '.tmp'
+    dataloader = make_dataloader(dataset, batch_size=256, shuffle=False)
+    features = None
+    offset = 0
+    model.eval()
+    with torch.inference_mode():
+        for (x, _) in dataloader:
+            with autocast():
+                out = model.prefix(x, n_stages)
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype,
+                                                     shape=(len(dataset), *out.shape[1:]))
+            features[offset:offset + out.size(0)] = out.float().cpu().numpy().astype(dtype)
+            offset += out.size(0)
+    features.flush()
+    del features
+    try:
+        os.replace(tmp_file, features_file)
+    except OSError:
+        # another process finished the same cache first
+        if not os.path.isfile(features_file):
+            raise
+        os.remove(tmp_file)
+
+def feature_cached_datasets(model, datasets):
+    # returns the datasets with the frozen part of the model replaced by cached activations, or None if the
+    # input of the frozen part changes between epochs (augmentation, MixUp/CutMix) or its batch norm
+    # estimates are updated
+    n_stages = model.frozen_stages()
+    if use_data_augmentation or use_cut_mix or use_mix_up:
+        print("Feature cache disabled: augmentation changes the input")
+        return None
+    if model.update_bn_estimate:
+        print("Feature cache disabled: batch norm estimates are updated")
+        return None
+    if n_stages == 0:
+        print("Feature cache disabled: no frozen layers")
+        return None
+    os.makedirs(feature_cache_dir, exist_ok=True)
+    cached = []
+    for dataset in datasets:
+        # splits selected by index files share their annotations file, the split hash tells them apart
+        name = os.path.splitext(os.path.basename(dataset.annotations_file))[0] + "_" + dataset.split_hash[:12]
+        features_file = (feature_cache_dir + "/features_resnet" + str(depth) + "_" + RESNET_STAGES[n_stages - 1] + "_"
+                         + name + ("_balanced" if dataset.balanced else "") + ".npy")
+        if not os.path.isfile(features_file):
+            print("Caching " + RESNET_STAGES[n_stages - 1] + " features of " + dataset.annotations_file)
+            build_feature_cache(model, dataset, n_stages, features_file)
+        cached.append(CachedFeatureDataset(dataset, features_file))
+    model.input_stage = n_stages
+    return cached
+
+def autocast():
+    # mixed precision context for forward pass and loss, selected with the precision config (fp32, bf16 or fp16)
+    if precision == 'fp32' or device not in ['cpu', 'cuda']:
+        return contextlib.nullcontext()
+    if precision == 'fp16' and device == 'cuda':
+        return torch.autocast(device_type=device, dtype=torch.float16)
+    return torch.autocast(device_type=device, dtype=torch.bfloat16)
+
+def train(train_dataloader, eval_dataloader, test_dataloader, model, loss_fn, metric_fns, optimizer, n_epochs, trial=None,
+          checkpoint_path=None, resume=False):
     global lowest_val_loss
     # training loop
     logdir = './tensorboard/net'
     writer = SummaryWriter(logdir)  # tensorboard writer (can also log images)
 
     history = {}  # collects metrics at the end of each epoch
+    # loss scaling is only needed (and available) for fp16 on cuda
+    scaler = torch.amp.GradScaler('cuda', enabled=(precision == 'fp16' and device == 'cuda'))
+
+    start_epoch = 0
+    if resume and checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        history = load_checkpoint(checkpoint_path, model, optimizer, scaler, loss_fn)
+        start_epoch = max(history) + 1 if history else 0
+        print('Resuming from ' + checkpoint_path + ' at epoch ' + str(start_epoch))
+    checkpoint_writer = CheckpointWriter() if checkpoint_path is not None else None
+    # output file names, trials of a sweep share ct (and may run in parallel), so they get their own names
+    filename = str(configfilename) + "_" + ct + ("_trial" + str(trial.number) if trial is not None else "")
+    val_writers = None  # predictions of the final validation pass
 
-    for epoch in range(n_epochs):  # loop over the dataset multiple times
+    for epoch in range(start_epoch, n_epochs):  # loop over the dataset multiple times
         print('Starting epoch ' + str(epoch))
 
-        # initialize metric list
-        metrics = {'loss': [], 'val_loss': []}
-        for k, _ in metric_fns.items():
-            metrics[k] = []
-            metrics['val_'+k] = []
+        # initialize streaming metrics, they accumulate on the device and only sync in compute()
+        metrics = {'loss': StreamingMean(), 'val_loss': StreamingMean()}
+        for k, fn in metric_fns.items():
+            metrics[k] = copy.deepcopy(fn)
+            metrics['val_'+k] = copy.deepcopy(fn)
+        for metric in metrics.values():
+            metric.reset()
 
         # training
         model.train()
@@ -173,77 +535,93 @@ def train(train_dataloader, eval_dataloader, model, loss_fn, metric_fns, optimiz
             optimizer.zero_grad()  # zero out gradients
             if(output_category=='combined'):
                 x_aug = x.clone()
-                y_race_aug, y_gender_aug = (y[0].clone(),y[1].clone())
-                y_aug=(y_race_aug, y_gender_aug)
+                y_aug = tuple(el.clone() for el in y)
             else:
                 x_aug=x.clone()
                 y_aug=y.clone()
-            if(use_data_augmentation):
-                x_aug=data_augmentation(x_aug,p_augment)
+            if(use_data_augmentation and not augment_in_workers):
+                x_aug=augmenter(x_aug)
+            sample_weights = None
             if(use_mix_up or use_cut_mix):
-                indices = torch.randperm(x.size(0))
+                indices = torch.randperm(x.size(0), device=x.device)
                 shuffled_x = x[indices]
                 if (output_category == 'combined'):
-                    y_race, y_gender = (y[0], y[1])
-                    shuffled_y_race = y_race[indices]
-                    shuffled_y_gender = y_gender[indices]
-                    shuffled_y=(shuffled_y_race,shuffled_y_gender)
+                    shuffled_y = tuple(el[indices] for el in y)
                 else:
                     shuffled_y=y[indices]
                 alpha = 0.2
                 dist = torch.distributions.beta.Beta(alpha, alpha)
+                if (output_category == 'combined' and hasattr(loss_fn, 'sample_weights')):
+                    # penalty weights of mixed samples are mixed with the same lambda as their labels
+                    sample_weights = loss_fn.sample_weights(y)
+                    shuffled_weights = sample_weights[indices]
                 if (np.random.normal() < p_augment and use_cut_mix):
-                    x_aug,y_aug = cutMix(x_aug, y_aug, shuffled_x, shuffled_y, dist)
+                    x_aug,y_aug,lam = cutMix(x_aug, y_aug, shuffled_x, shuffled_y, dist)
+                    if sample_weights is not None:
+                        sample_weights = sample_weights * lam + shuffled_weights * (1 - lam)
                 if (np.random.normal() < p_augment and use_mix_up):
-                    x_aug, y_aug = mixUp(x_aug, y_aug, shuffled_x, shuffled_y, dist)
+                    x_aug, y_aug, lam = mixUp(x_aug, y_aug, shuffled_x, shuffled_y, dist)
+                    if sample_weights is not None:
+                        sample_weights = sample_weights * lam + shuffled_weights * (1 - lam)
 
-            y_hat = model(x_aug)  # forward pass
-            loss = loss_fn(y_hat, y_aug)
-            loss.backward()  # backward pass
-            optimizer.step()  # optimize weights
+            with autocast():
+                y_hat = model(x_aug)  # forward pass
+                loss = loss_fn(y_hat, y_aug, sample_weights=sample_weights)
+            scaler.scale(loss).backward()  # backward pass
+            scaler.step(optimizer)  # optimize weights
+            scaler.update()
             # log partial metrics
-            metrics['loss'].append(loss.item())
-            for k, fn in metric_fns.items():
-                metrics[k].append(fn(y_hat, y).item() if type(fn(y_hat, y)) is not tuple else
-                                  tuple([el.item() for el in fn(y_hat, y)]))
+            metrics['loss'].update(loss.detach(), x.size(0))
+            for k in metric_fns:
+                metrics[k].update(y_hat, y)
 
         # validation
-        loss_sum = 0 #for pruning
         model.eval()
+        if epoch == n_epochs - 1:
+            # the last validation pass also streams its predictions to disk, they are kept if the run is the best
+            val_writers = prediction_writers(model, eval_dataloader, "val_predictions_" + filename + STORE_SUFFIX,
+                                             'val', truth_path="val_groundtruth_" + filename + STORE_SUFFIX)
         with torch.no_grad():  # do not keep track of gradients
             for (x, y) in eval_dataloader:
-                y_hat = model(x)  # forward pass
-                loss = loss_fn(y_hat, y)
+                with autocast():
+                    y_hat = model(x)  # forward pass
+                    loss = loss_fn(y_hat, y)
                 # log partial metrics
-                metrics['val_loss'].append(loss.item())
-                for k, fn in metric_fns.items():
-                    metrics['val_' + k].append(fn(y_hat, y).item() if type(fn(y_hat, y)) is not tuple else
-                                               tuple([el.item() for el in fn(y_hat, y)]))
-                    loss_sum += metrics['val_loss'][-1]/len(eval_dataloader)
-            if do_tuning:
-                # log loss for pruning
-                trial.report(loss_sum, epoch)
-                if trial.should_prune():
-                    raise optuna.exceptions.TrialPruned()
-
-        # summarize metrics, log to tensorboard and display
-        if type(metrics['acc'][0]) is not tuple:
-            history[epoch] = {k: sum(v) / len(v) for k, v in metrics.items()}
-        else:
-            history[epoch] = {'loss': sum(metrics['loss'])/len(metrics['loss']),
-                              'val_loss': sum(metrics['val_loss'])/len(metrics['val_loss']),
-                              'acc':(sum(i for i, _, _ in metrics['acc'])/len(metrics['acc']),
-                                     sum(i for _, i, _ in metrics['acc'])/len(metrics['acc']),
-                                     sum(i for _, _, i in metrics['acc'])/len(metrics['acc'])),
-                              'val_acc':(sum(i for i, _, _ in metrics['val_acc'])/len(metrics['val_acc']),
-                                         sum(i for _, i, _ in metrics['val_acc'])/len(metrics['val_acc']),
-                                         sum(i for _, _, i in metrics['val_acc'])/len(metrics['val_acc']))
-                          }
+                metrics['val_loss'].update(loss, x.size(0))
+                for k in metric_fns:
+                    metrics['val_' + k].update(y_hat, y)
+                if val_writers is not None:
+                    write_predictions(val_writers, model, y_hat, y)
+
+        # summarize metrics (the only host syncs of the epoch), log to tensorboard and display
+        history[epoch] = {k: metric.compute() for k, metric in metrics.items()}
+        if do_tuning:
+            # log loss for pruning
+            trial.report(history[epoch]['val_loss'], epoch)
+            if trial.should_prune():
+                if val_writers is not None:
+                    close_writers(val_writers, keep=False)
+                raise optuna.exceptions.TrialPruned()
         print(' '.join(['\t- '+str(k)+' = '+str(v)+'\n ' for (k, v) in history[epoch].items()]))
+        if (attention_update_every > 0 and (epoch + 1) % attention_update_every == 0 and epoch < n_epochs - 1
+                and output_category == 'combined' and hasattr(loss_fn, 'set_penalty_weights')):
+            # adaptive reweighting: the attention scores of this epoch's per-group validation accuracies become
+            # the penalty weights of the following epochs (they are part of the loss state in checkpoints)
+            group_acc = history[epoch]['val_group_acc']
+            names = [r + ' ' + g for r in RACE_NAMES for g in GENDER_NAMES]
+            loss_fn.set_penalty_weights(attention_scores(100 * np.array([group_acc[name] for name in names])))
+            print('Updated loss penalty weights: ' + str(loss_fn.loss_penalty_weights.tolist()))
+        if use_data_augmentation and not augment_in_workers:
+            print('Augmentation throughput: ' + str(round(augmenter.throughput())) + ' images/s (last batch: '
+                  + str(round(augmenter.last_throughput)) + ' images/s)')
+        if checkpoint_writer is not None and ((epoch + 1) % checkpoint_every == 0 or epoch == n_epochs - 1):
+            checkpoint_writer.save(checkpoint_state(model, optimizer, scaler, loss_fn, history), checkpoint_path)
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
     print('Finished Training')
     val_loss = history[n_epochs-1]['val_loss']
-    if (not do_tuning) or val_loss < lowest_val_loss:
+    if (not do_tuning) or val_loss < best_val_loss(trial):
         lowest_val_loss = val_loss
         # plot loss curve
         fig, ax = plt.subplots(1)
@@ -254,12 +632,15 @@ def train(train_dataloader, eval_dataloader, model, loss_fn, metric_fns, optimiz
         ax.set_title("Loss for config file= " + str(configfilename))
         ax.legend()
         # fig.show()
-        graphname = "Loss_graph_" + str(configfilename) + "_" + ct + ".png"
+        graphname = "Loss_graph_" + filename + ".png"
         print("Saved loss graph with filename: " + graphname)
         fig.savefig(graphname)
         #plot other metrics
         for metricname, _ in metric_fns.items():
-            if type(history[0][metricname]) is not tuple:
+            if type(history[0][metricname]) is dict:
+                # per-group metrics are only printed
+                continue
+            elif type(history[0][metricname]) is not tuple:
                 fig2, ax2 = plt.subplots(1)
                 ax2.plot([v[metricname] for k, v in history.items()], label=('Training ' + metricname))
                 ax2.plot([v['val_' + metricname] for k, v in history.items()], label=('Validation ' + metricname))
@@ -268,7 +649,7 @@ def train(train_dataloader, eval_dataloader, model, loss_fn, metric_fns, optimiz
                 ax2.set_title(str(metricname + " for config file= " + str(configfilename)))
                 ax2.legend()
                 # fig2.show()
-                graphname = metricname + "_graph_" + str(configfilename) + "_" + ct + ".png"
+                graphname = metricname + "_graph_" + filename + ".png"
                 print("Saved " + metricname + " graph with filename: " + graphname)
                 fig2.savefig(graphname)
             else:
@@ -281,7 +662,7 @@ def train(train_dataloader, eval_dataloader, model, loss_fn, metric_fns, optimiz
                 ax2.set_title(str(metricname + " for race for config file= " + str(configfilename)))
                 ax2.legend()
                 # fig2.show()
-                graphname = metricname + "_race_graph_" + str(configfilename) + "_" + ct + ".png"
+                graphname = metricname + "_race_graph_" + filename + ".png"
                 print("Saved " + metricname + " graph with filename: " + graphname)
                 fig2.savefig(graphname)
                 #gender
@@ -293,7 +674,7 @@ def train(train_dataloader, eval_dataloader, model, loss_fn, metric_fns, optimiz
                 ax2.set_title(str(metricname + " for gender for config file= " + str(configfilename)))
                 ax2.legend()
                 # fig2.show()
-                graphname = metricname + "_gender_graph_" + str(configfilename) + "_" + ct + ".png"
+                graphname = metricname + "_gender_graph_" + filename + ".png"
                 print("Saved " + metricname + " graph with filename: " + graphname)
                 fig2.savefig(graphname)
                 fig2.savefig(graphname)
@@ -306,36 +687,145 @@ def train(train_dataloader, eval_dataloader, model, loss_fn, metric_fns, optimiz
                 ax2.set_title(str(metricname + " for combined for config file= " + str(configfilename)))
                 ax2.legend()
                 # fig2.show()
-                graphname = metricname + "_combined_graph_" + str(configfilename) + "_" + ct + ".png"
+                graphname = metricname + "_combined_graph_" + filename + ".png"
                 print("Saved " + metricname + " graph with filename: " + graphname)
                 fig2.savefig(graphname)
-        model.eval()
-        val_pred = []
-        val_truth = []
-        with torch.no_grad():  # do not keep track of gradients
-            for (x, y) in eval_dataloader:
-                val_pred.append(model(x))  # forward pass
-                val_truth.append(y)
-        # save predictions
-        filename = str(configfilename) + "_" + ct
-        pred_file = open("val_predictions_" + filename + ".pkl", "wb")  # create new file if this doesn't exist yet
-        truth_file = open("val_groundtruth_" + filename + ".pkl", "wb")  # create new file if this doesn't exist yet
-        pkl.dump(val_pred, pred_file)
-        pkl.dump(val_truth, truth_file)
-        pred_file.close()
-        truth_file.close()
-        test_pred = []
-        test_truth = []
-        with torch.no_grad():  # do not keep track of gradients
-            for (x, y) in test_dataloader:
-                test_pred.append(model(x))  # forward pass
-                test_truth.append(y)
-        # save predictions
-        filename = str(configfilename) + "_" + ct
-        pred_file = open("predictions_" + filename + ".pkl", "wb")  # create new file if this doesn't exist yet
-        pkl.dump(test_pred, pred_file)
-        pred_file.close()
-    return lowest_val_loss
+        # save predictions, the validation predictions were captured during the last epoch unless the run was
+        # resumed after it
+        if val_writers is not None:
+            close_writers(val_writers)
+        else:
+            save_predictions(model, eval_dataloader, "val_predictions_" + filename + STORE_SUFFIX, 'val',
+                             truth_path="val_groundtruth_" + filename + STORE_SUFFIX)
+        save_predictions(model, test_dataloader, "predictions_" + filename + STORE_SUFFIX, 'test')
+    elif val_writers is not None:
+        close_writers(val_writers, keep=False)
+    return val_loss
+
+def outputs_to_numpy(outputs):
+    # model outputs or labels (tensor or tuple of tensors, one per head) as a list of float32 arrays
+    if not isinstance(outputs, (tuple, list)):
+        outputs = (outputs,)
+    return [el.float().cpu().numpy() for el in outputs]
+
+def prediction_writers(model, dataloader, path, split, truth_path=None):
+    # prediction store for the probabilities of the model on the dataloader, plus a store for the labels if
+    # truth_path is given
+    heads = model.output_heads()
+    head_sizes = {name: len(LABEL_NAMES[name]) for name in heads}
+    dataset = dataloader.dataloader.dataset
+    if isinstance(dataset, CachedFeatureDataset):
+        dataset = dataset.dataset
+    n_samples = len(dataset)
+    metadata = {'config': str(configfilename), 'timestamp': ct, 'split': split, 'split_hash': dataset.split_hash,
+                'annotations_file': dataset.annotations_file, 'indices_file': dataset.indices_file,
+                'balanced': bool(dataset.balanced)}
+    pred_writer = PredictionWriter(path, n_samples, head_sizes, {**metadata, 'kind': 'predictions'}, prediction_dtype)
+    truth_writer = None
+    if truth_path is not None:
+        truth_writer = PredictionWriter(truth_path, n_samples, head_sizes, {**metadata, 'kind': 'groundtruth'}, prediction_dtype)
+    return pred_writer, truth_writer
+
+def write_predictions(writers, model, y_hat, y):
+    pred_writer, truth_writer = writers
+    pred_writer.write(outputs_to_numpy(model.to_probabilities(y_hat)))
+    if truth_writer is not None:
+        truth_writer.write(outputs_to_numpy(y))
+
+def close_writers(writers, keep=True):
+    # keep=False discards the stores
+    for writer in writers:
+        if writer is None:
+            continue
+        if keep:
+            writer.close()
+        else:
+            writer.abort()
+
+def save_predictions(model, dataloader, path, split, truth_path=None):
+    # runs the model over the dataset of the dataloader in batches of inference_batch_size and streams the
+    # predicted probabilities (and the labels if truth_path is given) batch by batch into prediction stores
+    writers = prediction_writers(model, dataloader, path, split, truth_path)
+    inference_dataloader = make_dataloader(dataloader.dataloader.dataset, batch_size=inference_batch_size, shuffle=False)
+    model.eval()
+    with torch.inference_mode():
+        for (x, y) in inference_dataloader:
+            with autocast():
+                y_hat = model(x)  # forward pass
+            write_predictions(writers, model, y_hat, y)
+    close_writers(writers)
+
+def state_to_cpu(state):
+    # copies (nested) tensors to the cpu, so that the checkpoint can be written while training continues
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+def checkpoint_state(model, optimizer, scaler, loss_fn, history):
+    state = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scaler': scaler.state_dict(),
+             'loss_fn': loss_fn.state_dict() if isinstance(loss_fn, nn.Module) else None,
+             'history': history, 'ct': ct, 'config': config_dict, 'lowest_val_loss': lowest_val_loss,
+             'model_config': {'output_category': model.output_category, 'depth': depth,
+                              'output_logits': model.output_logits, 'head_names': list(model.head_names),
+                              'additional_heads': list(additional_heads)},
+             'rng': {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate(),
+                     'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}}
+    return state_to_cpu(state)
+
+def load_checkpoint(checkpoint_path, model, optimizer, scaler, loss_fn):
+    # restores model, optimizer and rng state from a checkpoint and returns the history up to its epoch
+    global lowest_val_loss
+    # checkpoints hold the config and numpy/python rng state, which the default weights_only=True load rejects.
+    # weights_only=False unpickles arbitrary objects, so only load checkpoints you wrote yourself (trusted files)
+    state = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    scaler.load_state_dict(state['scaler'])
+    if state['loss_fn'] is not None:
+        loss_fn.load_state_dict(state['loss_fn'])
+    lowest_val_loss = min(lowest_val_loss, state['lowest_val_loss'])
+    torch.set_rng_state(state['rng']['torch'])
+    np.random.set_state(state['rng']['numpy'])
+    random.setstate(state['rng']['python'])
+    if state['rng']['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['rng']['cuda'])
+    return state['history']
+
+class CheckpointWriter:
+    # writes checkpoints with torch.save in a background thread, the training loop only waits for the copy to the cpu
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path):
+        self.queue.put((state, path))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, path = item
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            # write to a temporary file first, so a preemption during the write keeps the previous checkpoint
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+def best_val_loss(trial):
+    # lowest final validation loss so far, over this process and all finished trials of the (shared) study
+    try:
+        return min(lowest_val_loss, trial.study.best_value)
+    except ValueError:
+        return lowest_val_loss
 
 def accuracy_fn(y_hat, y):
     # computes classification accuracy
@@ -348,8 +838,71 @@ def accuracy_fn(y_hat, y):
     else:
         return (torch.argmax(y_hat, dim=1) == torch.argmax(y, dim=1)).float().mean()
 
-def data_augmentation(image, prob):
-  translayers = transforms.RandomApply(
+class StreamingMean:
+    # running mean of a (device) tensor over an epoch, weighted by the number of samples of each update
+    def reset(self):
+        self.total = 0.
+        self.count = 0
+
+    def update(self, value, n):
+        self.total = self.total + value.detach() * n
+        self.count += n
+
+    def compute(self):
+        return float(self.total / max(self.count, 1))
+
+class StreamingAccuracy:
+    # accuracy_fn over a whole epoch, correct predictions are counted on the device and divided once in compute()
+    def reset(self):
+        self.correct = None
+        self.count = 0
+
+    def update(self, y_hat, y):
+        if type(y_hat) is tuple:
+            correct = torch.stack([(torch.argmax(y_hat[i], dim=1) == torch.argmax(y[i], dim=1)).sum() for i in range(2)])
+        else:
+            correct = (torch.argmax(y_hat, dim=1) == torch.argmax(y, dim=1)).sum()
+        self.correct = correct if self.correct is None else self.correct + correct
+        self.count += y_hat[0].size(0) if type(y_hat) is tuple else y_hat.size(0)
+
+    def compute(self):
+        acc = (self.correct.double() / max(self.count, 1)).cpu()
+        if acc.dim() == 0:
+            return float(acc)
+        return (float(acc[0]), float(acc[1]), float(acc.mean()))
+
+class StreamingGroupAccuracy:
+    # confusion counts over the 14 race x gender classes (2*race+gender, both heads must be right) for combined
+    # models, or over the classes of the single head otherwise; compute() returns the accuracy per class and
+    # keeps the confusion matrix (rows: true class, columns: predicted class) in self.confusion
+    def reset(self):
+        self.counts = None
+        self.confusion = None
+
+    def classes(self, y_hat, y):
+        if type(y_hat) is tuple:
+            true = 2 * torch.argmax(y[0], dim=1) + torch.argmax(y[1], dim=1)
+            pred = 2 * torch.argmax(y_hat[0], dim=1) + torch.argmax(y_hat[1], dim=1)
+            names = [r + ' ' + g for r in RACE_NAMES for g in GENDER_NAMES]
+        else:
+            true, pred = torch.argmax(y, dim=1), torch.argmax(y_hat, dim=1)
+            names = GENDER_NAMES if y_hat.size(1) == 2 else RACE_NAMES
+        return true, pred, names
+
+    def update(self, y_hat, y):
+        true, pred, self.names = self.classes(y_hat, y)
+        k = len(self.names)
+        counts = torch.bincount(true * k + pred, minlength=k * k)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def compute(self):
+        k = len(self.names)
+        self.confusion = self.counts.view(k, k).cpu().numpy()
+        acc = np.diag(self.confusion) / np.maximum(self.confusion.sum(axis=1), 1)
+        return {name: float(a) for name, a in zip(self.names, acc)}
+
+def augmentation_transforms(prob):
+  return transforms.RandomApply(
       torch.nn.Sequential(
         torchvision.transforms.RandomHorizontalFlip(0.5),
         torchvision.transforms.ColorJitter(0.2, 0.15, 0.15, 0.05),
@@ -363,7 +916,96 @@ def data_augmentation(image, prob):
         ), p=prob
   )
 
-  return translayers(image)
+class BatchAugmentation(nn.Module):
+    # same augmentations as augmentation_transforms, but built once and applied to a whole batch with independent
+    # random parameters per image: colour jitter as per-image tensor ops, flip, affine and crop+resize folded into
+    # a single batched affine_grid/grid_sample, all on the device the batch is on
+    def __init__(self, prob, brightness=0.2, contrast=0.15, saturation=0.15, hue=0.05, degrees=6, translate=(0.1, 0.1),
+                 shear=5, crop_size=200, image_size=224, p_crop=0.4, synchronize=False):
+        super().__init__()
+        self.prob = prob
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.degrees = degrees
+        self.translate = translate
+        self.shear = shear
+        self.crop_scale = crop_size / image_size
+        self.p_crop = p_crop
+        # on cuda the timing only measures kernel launches unless the device is synchronized after each batch
+        self.synchronize = synchronize
+        self.images_seen = 0
+        self.seconds = 0.
+        self.last_throughput = 0.
+        rgb_to_yiq = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+        self.register_buffer('rgb_to_yiq', rgb_to_yiq, persistent=False)
+        self.register_buffer('yiq_to_rgb', torch.linalg.inv(rgb_to_yiq), persistent=False)
+
+    def uniform(self, n, low, high, device):
+        return torch.rand(n, device=device) * (high - low) + low
+
+    def color_jitter(self, x):
+        n = x.size(0)
+        b = self.uniform(n, 1 - self.brightness, 1 + self.brightness, x.device).view(n, 1, 1, 1)
+        c = self.uniform(n, 1 - self.contrast, 1 + self.contrast, x.device).view(n, 1, 1, 1)
+        s = self.uniform(n, 1 - self.saturation, 1 + self.saturation, x.device).view(n, 1, 1, 1)
+        h = self.uniform(n, -self.hue, self.hue, x.device) * 2 * np.pi
+        x = (x * b).clamp(0, 1)
+        gray = (x * self.rgb_to_yiq[0].view(1, 3, 1, 1)).sum(dim=1, keepdim=True)
+        x = ((x - gray.mean(dim=(2, 3), keepdim=True)) * c + gray.mean(dim=(2, 3), keepdim=True)).clamp(0, 1)
+        gray = (x * self.rgb_to_yiq[0].view(1, 3, 1, 1)).sum(dim=1, keepdim=True)
+        x = ((x - gray) * s + gray).clamp(0, 1)
+        # hue shift as a rotation of the chroma plane in YIQ space, one 3x3 colour matrix per image
+        cos, sin = torch.cos(h), torch.sin(h)
+        rotation = torch.zeros(n, 3, 3, device=x.device)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+        rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+        color_matrix = self.yiq_to_rgb @ rotation @ self.rgb_to_yiq
+        return torch.einsum('nij,njhw->nihw', color_matrix, x).clamp(0, 1)
+
+    def geometric(self, x):
+        # builds per image the map from output to input coordinates (normalized to [-1, 1]) of
+        # flip -> affine -> crop+resize and samples the whole batch with it at once
+        n = x.size(0)
+        eye = torch.eye(3, device=x.device).repeat(n, 1, 1)
+        flip = eye.clone()
+        flip[:, 0, 0] = torch.where(torch.rand(n, device=x.device) < 0.5, -1., 1.)
+        angle = self.uniform(n, -self.degrees, self.degrees, x.device) * np.pi / 180
+        shear = self.uniform(n, -self.shear, self.shear, x.device) * np.pi / 180
+        affine = eye.clone()
+        affine[:, 0, 0], affine[:, 0, 1] = torch.cos(angle), -torch.sin(angle + shear)
+        affine[:, 1, 0], affine[:, 1, 1] = torch.sin(angle), torch.cos(angle + shear)
+        affine[:, 0, 2] = self.uniform(n, -self.translate[0], self.translate[0], x.device) * 2
+        affine[:, 1, 2] = self.uniform(n, -self.translate[1], self.translate[1], x.device) * 2
+        crop = eye.clone()
+        do_crop = torch.rand(n, device=x.device) < self.p_crop
+        scale = torch.where(do_crop, self.crop_scale, 1.)
+        max_offset = 1 - scale
+        crop[:, 0, 0], crop[:, 1, 1] = scale, scale
+        crop[:, 0, 2] = (torch.rand(n, device=x.device) * 2 - 1) * max_offset
+        crop[:, 1, 2] = (torch.rand(n, device=x.device) * 2 - 1) * max_offset
+        theta = (flip @ torch.linalg.inv(affine) @ crop)[:, :2]
+        grid = nn.functional.affine_grid(theta, list(x.shape), align_corners=False)
+        return nn.functional.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    def forward(self, x):
+        start = time.perf_counter()
+        augmented = self.geometric(self.color_jitter(x))
+        apply = (torch.rand(x.size(0), device=x.device) < self.prob).view(-1, 1, 1, 1)
+        out = torch.where(apply, augmented, x)
+        if self.synchronize and x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        seconds = time.perf_counter() - start
+        self.images_seen += x.size(0)
+        self.seconds += seconds
+        self.last_throughput = x.size(0) / max(seconds, 1e-9)
+        return out
+
+    def throughput(self):
+        # images per second over all batches seen so far
+        return self.images_seen / max(self.seconds, 1e-9)
 
 # inspired by https://towardsdatascience.com/cutout-mixup-and-cutmix-implementing-modern-image-augmentations-in-pytorch-a9d7db3074ad
 def cutMix(data_orig, labels, shuffled_data, shuffled_labels, dist):
@@ -374,14 +1016,10 @@ def cutMix(data_orig, labels, shuffled_data, shuffled_labels, dist):
     # adjust lambda to exactly match pixel ratio
     lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (data_orig.size()[-1] * data_orig.size()[-2]))
     if (type(labels) is tuple):
-        race_label, gender_label = labels[0], labels[1]
-        race_label_shuff, gender_label_shuff = shuffled_labels[0], shuffled_labels[1]
-        new_targets_race = race_label * lam + race_label_shuff * (1 - lam)
-        new_targets_gender = gender_label * lam + gender_label_shuff * (1 - lam)
-        new_targets=(new_targets_race,new_targets_gender)
+        new_targets = tuple(label * lam + label_shuff * (1 - lam) for label, label_shuff in zip(labels, shuffled_labels))
     else:
         new_targets = labels * lam + shuffled_labels * (1 - lam)
-    return mixed, new_targets
+    return mixed, new_targets, lam
 
 def rand_bbox(size, lam):
     W = size[2]
@@ -409,58 +1047,190 @@ def mixUp(data, labels, shuffled_data, shuffled_labels, dist):
     # (one from each dataset) into one image/label
     images = data * l + shuffled_data * (1 - l)
     if (type(labels) is tuple):
-        race_label, gender_label = labels[0], labels[1]
-        race_label_shuff, gender_label_shuff = shuffled_labels[0], shuffled_labels[1]
-        new_targets_race = race_label * l + race_label_shuff * (1 - l)
-        new_targets_gender = gender_label * l + gender_label_shuff * (1 - l)
-        labels=(new_targets_race,new_targets_gender)
+        labels = tuple(label * l + label_shuff * (1 - l) for label, label_shuff in zip(labels, shuffled_labels))
     else:
         labels = labels * l + shuffled_labels * (1 - l)
-    return (images, labels)
-
-def bce_loss(yhat, y):
-    if(type(yhat) is tuple):
-        race_label,gender_label=y[0],y[1]
-        race_label_hat,gender_label_hat=yhat[0],yhat[1]
-        batch_weights=np.ones(shape=y[0].size(0))
-        for i in range(y[0].size(0)):
-            batch_weights[i]=loss_penalty_weights[2*np.argmax(race_label[i].cpu())+np.argmax(gender_label[i].cpu())]
-        batch_weights_tensor= torch.tensor(batch_weights).to(device=device, non_blocking=True)
-        loss_fn = nn.BCELoss(reduction='none')#weight=batch_weights_tensor)
-        l1=torch.mean(loss_fn(race_label_hat, race_label), 1)
-        l2=torch.mean(loss_fn(gender_label_hat, gender_label), 1)
-        l1 = torch.mean(l1*batch_weights_tensor)
-        l2 = torch.mean(l2*batch_weights_tensor)
-        return (l1+l2)/2
+    return (images, labels, l)
+
+def softmax_bce_from_logits(logits, y):
+    # elementwise binary_cross_entropy(softmax(logits), y) without forming the probabilities: log p comes from
+    # log_softmax and log(1 - p_i) = logsumexp(logits without class i) - logsumexp(logits), both clamped at -100 like
+    # binary_cross_entropy does. Unlike log(1 - exp(log p)) this stays finite (with finite gradients) when p rounds to 1
+    logits = logits.float()
+    n_classes = logits.size(1)
+    others = logits.unsqueeze(1).expand(-1, n_classes, -1).masked_fill(
+        torch.eye(n_classes, dtype=torch.bool, device=logits.device), float('-inf'))
+    log_norm = torch.logsumexp(logits, dim=1, keepdim=True)
+    log_p = logits - log_norm
+    log_1mp = torch.logsumexp(others, dim=2) - log_norm
+    return -(y * log_p.clamp(min=-100) + (1 - y) * log_1mp.clamp(min=-100))
+
+class PenaltyWeightedBCELoss(nn.Module):
+    # BCE over all prediction heads, the race and gender losses are weighted per sample with the
+    # loss_penalty_weights entry of its class (2*race+gender); the weights live on the device as a buffer
+    # and are gathered with one batched argmax, so no host syncs are needed
+    def __init__(self, loss_penalty_weights, focal_alpha=None, focal_gamma=None, from_logits=False):
+        super().__init__()
+        self.register_buffer('loss_penalty_weights', torch.as_tensor(loss_penalty_weights, dtype=torch.float32))
+        # from_logits takes the logits of models built with output_logits and computes the same BCE on their softmax
+        # probabilities, from log_softmax so that it is stable under autocast
+        self.from_logits = from_logits
+        # with focal_gamma set, every per-sample loss l is modulated to focal_alpha*(1-exp(-l))**focal_gamma*l
+        self.focal_alpha = focal_alpha
+        self.focal_gamma = focal_gamma
+
+    def set_penalty_weights(self, loss_penalty_weights):
+        self.loss_penalty_weights.copy_(torch.as_tensor(loss_penalty_weights, dtype=torch.float32))
+
+    def sample_weights(self, y):
+        # exact for one-hot labels, for MixUp/CutMix labels mix the weights of the two unmixed samples instead
+        class_idx = 2 * torch.argmax(y[0], dim=1) + torch.argmax(y[1], dim=1)
+        return self.loss_penalty_weights[class_idx]
+
+    def sample_losses(self, yhat, y):
+        # mean BCE over the classes of one head, one value per sample
+        if self.from_logits:
+            l = torch.mean(softmax_bce_from_logits(yhat, y), 1)
+        else:
+            l = torch.mean(nn.functional.binary_cross_entropy(yhat, y, reduction='none'), 1)
+        if self.focal_gamma is not None:
+            l = self.focal_alpha * (1 - torch.exp(-l)) ** self.focal_gamma * l
+        return l
+
+    def forward(self, yhat, y, sample_weights=None):
+        if type(yhat) is not tuple:
+            return torch.mean(self.sample_losses(yhat, y))
+        if sample_weights is None:
+            sample_weights = self.sample_weights(y)
+        l1 = torch.mean(self.sample_losses(yhat[0], y[0]) * sample_weights)
+        l2 = torch.mean(self.sample_losses(yhat[1], y[1]) * sample_weights)
+        # additional heads (e.g. age) are not penalty weighted
+        l_additional = [torch.mean(self.sample_losses(el_hat, el)) for el_hat, el in zip(yhat[2:], y[2:])]
+        return (l1+l2+sum(l_additional))/(2+len(l_additional))
+
+def load_attention_weights(source):
+    # per-class weights (2*race+gender order) from an attention scores file written by prediction_analysis,
+    # source is the path of the json file or the name of the analysed run, e.g. config_combined_bal_aug_<ct>
+    # (the attention scores of its validation predictions are preferred)
+    candidates = [source] + ['attention_scores/attention_scores_' + prefix + source + '.json'
+                             for prefix in ['val_predictions_', 'predictions_', '']]
+    for fn in candidates:
+        if os.path.isfile(fn):
+            with open(fn, 'r') as f:
+                scores = json.load(f)
+            break
     else:
-        loss_fn = nn.BCELoss()
-        return loss_fn(yhat, y)
+        raise FileNotFoundError('No attention scores found for ' + str(source))
+    names = [r + ' ' + g for r in RACE_NAMES for g in GENDER_NAMES]
+    missing = [name for name in names if name not in scores]
+    if missing:
+        raise ValueError(fn + ' has no attention scores for ' + ', '.join(missing))
+    print('Using attention scores of ' + fn)
+    return [scores[name] for name in names]
+
+class RegularizedBCELoss(PenaltyWeightedBCELoss):
+    # BCE plus lmbd times the variance of the mean losses of the 14 race x gender classes. The class losses are
+    # reduced on the device with one index_add/bincount, so the variance term is part of the autograd graph.
+    # With momentum > 0 the class losses are blended with a running (EMA) estimate, which keeps the variance
+    # stable when a batch only contains a few samples of some classes
+    def __init__(self, lmbd, momentum=0., num_classes=14, from_logits=False):
+        super().__init__(torch.ones(num_classes), from_logits=from_logits)
+        self.lmbd = lmbd
+        self.momentum = momentum
+        self.num_classes = num_classes
+        self.register_buffer('running_class_losses', torch.zeros(num_classes))
+        self.register_buffer('running_seen', torch.zeros(num_classes, dtype=torch.bool))
+
+    def class_losses(self, sample_losses, class_idx):
+        sums = torch.zeros(self.num_classes, device=sample_losses.device, dtype=sample_losses.dtype)
+        sums = sums.index_add(0, class_idx, sample_losses)
+        counts = torch.bincount(class_idx, minlength=self.num_classes)
+        return sums / counts.clamp(min=1), counts > 0
+
+    def forward(self, yhat, y, sample_weights=None):
+        l1 = self.sample_losses(yhat[0], y[0])
+        l2 = self.sample_losses(yhat[1], y[1])
+        class_idx = 2 * torch.argmax(y[0], dim=1) + torch.argmax(y[1], dim=1)
+        class_losses, present = self.class_losses(l1 + l2, class_idx)
+        if self.momentum > 0 and torch.is_grad_enabled():
+            # only training steps update the running estimate, the gradient flows through the current batch's share
+            previous = torch.where(self.running_seen, self.running_class_losses, class_losses.detach())
+            blended = self.momentum * previous + (1 - self.momentum) * class_losses
+            class_losses = torch.where(present, blended, self.running_class_losses)
+            present = present | self.running_seen
+            self.running_class_losses.copy_(class_losses.detach())
+            self.running_seen.copy_(present)
+        # population variance over the classes present, computed with masks to avoid a host sync
+        n = present.sum().clamp(min=1)
+        mean = torch.sum(class_losses * present) / n
+        var = torch.sum((class_losses - mean) ** 2 * present) / n
+
+        l = (torch.mean(l1) + torch.mean(l2)) / 2
+        return l + self.lmbd*var
 
-def focal_loss(yhat, y):
-    BCE = bce_loss(yhat, y)
-    BCE_exp = torch.exp(-BCE)
-    return focal_alpha*(1-BCE_exp)**focal_gamma*BCE
+def build_model(layers_to_train, train_bn_params, update_bn_estimate):
+    # builds a FaceResNet with the model settings of the config
+    model = FaceResNet(output_category, layers_to_train, train_bn_params, update_bn_estimate, depth, output_logits)
+    for name in additional_heads:
+        model.add_head(name, len(LABEL_NAMES[name]))
+    if channels_last:
+        model = model.use_channels_last()
+    return model.to(device=device)
 
-def regularized_BCE(yhat, y):
-    race_label, gender_label = y[0], y[1]
-    race_label_hat, gender_label_hat = yhat[0], yhat[1]
-    loss_fn = nn.BCELoss(reduction='none')  # weight=batch_weights_tensor)
-    l1 = torch.mean(loss_fn(race_label_hat, race_label), 1)
-    l2 = torch.mean(loss_fn(gender_label_hat, gender_label), 1)
+def make_dataloaders(model, batch_size):
+    # train, val and test loaders for the model, on cached features of its frozen layers if use_feature_cache is set
+    cached = feature_cached_datasets(model, [training_data, val_data, test_data]) if use_feature_cache else None
+    if cached is None:
+        return (make_dataloader(training_data, batch_size=batch_size, shuffle=True, sampler=train_sampler),
+                val_dataloader, test_dataloader)
+    return (make_dataloader(cached[0], batch_size=batch_size, shuffle=True, sampler=train_sampler),
+            make_dataloader(cached[1], batch_size=128, shuffle=False),
+            make_dataloader(cached[2], batch_size=128, shuffle=False))
 
-    class_losses = np.zeros(14)
-    for i in range(y[0].size(0)):
-        curr_class = 2 * np.argmax(race_label[i].cpu()) + np.argmax(gender_label[i].cpu())
-        class_losses[curr_class] += l1[i].cpu()+l2[i].cpu()
+def make_study_storage():
+    # trials send heartbeats, so trials of a killed or preempted run are marked failed and retried with the same
+    # parameters (continuing from their checkpoint) when the study is resumed
+    return optuna.storages.RDBStorage(study_storage, heartbeat_interval=60, grace_period=180,
+                                      failed_trial_callback=optuna.storages.RetryFailedTrialCallback(max_retry=3))
 
-    non_zero_class_losses = class_losses[class_losses!=0]
-    var = np.var(non_zero_class_losses)
+def optimize_study(study):
+    # runs trials until the study holds n_optuna_trials finished (complete or pruned) trials
+    finished_states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    if len(study.get_trials(deepcopy=False, states=finished_states)) >= n_optuna_trials:
+        return
+    study.optimize(objective, callbacks=[optuna.study.MaxTrialsCallback(n_optuna_trials, states=finished_states)])
 
-    l1 = torch.mean(l1)
-    l2 = torch.mean(l2)
-    l = (l1 + l2) / 2
+def sweep_worker(n_threads):
+    torch.set_num_threads(n_threads)
+    study = optuna.load_study(study_name=study_name, storage=make_study_storage(),
+                              sampler=optuna.samplers.TPESampler(), pruner=optuna.pruners.MedianPruner())
+    optimize_study(study)
 
-    return l + lmbd*var
+def run_sweep_worker(script, configfilename, study_name):
+    # entry point of a spawned sweep process: runs the setup of the script in the fresh interpreter (its own
+    # device context) and then joins the study instead of creating one
+    sys.argv = [script, configfilename, "--sweep-worker", study_name]
+    runpy.run_path(script, run_name="__main__")
+
+def run_sweep():
+    # runs the optuna study with n_parallel_trials trials at a time, each in its own process. The processes share the
+    # study through a sqlite storage. They are spawned rather than forked, because this process has already
+    # initialised the device (cuda cannot be re-initialised in a forked child)
+    study = optuna.create_study(study_name=study_name, storage=make_study_storage(), load_if_exists=True,
+                                direction="minimize", sampler=optuna.samplers.TPESampler(),
+                                pruner=optuna.pruners.MedianPruner())
+    if n_parallel_trials <= 1:
+        optimize_study(study)  # -> function given by objective
+        return study
+    pretrained_resnet(depth)  # downloads the weights once instead of in every worker
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=run_sweep_worker, args=(os.path.abspath(sys.argv[0]), configfilename, study_name))
+               for _ in range(n_parallel_trials)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return optuna.load_study(study_name=study_name, storage=make_study_storage())
 
  # Define a set of hyperparameter values, build the model, train the model, and evaluate the accuracy
 def objective(trial):
@@ -482,16 +1252,33 @@ def objective(trial):
         print("No valid layer_to_train_option")
     print("Params in current trial:")
     print(params)
-    train_dataloader = DataLoader(training_data, batch_size=params['batch_size'], shuffle=True)
-    print("Train datasets loaded")
     #model=load_model(num_classes, layers_to_train, params["train_bn_params"], params["update_bn_estimate"])
-    model = FaceResNet(output_category, layers_to_train, params["train_bn_params"], params["update_bn_estimate"], depth).to(device=device)
+    model = build_model(layers_to_train, params["train_bn_params"], params["update_bn_estimate"])
     print("Model loaded")
-    loss_fn = bce_loss
-    metric_fns = {'acc': accuracy_fn}
+    train_dataloader, trial_val_dataloader, trial_test_dataloader = make_dataloaders(model, params['batch_size'])
+    print("Train datasets loaded")
+    loss_fn = PenaltyWeightedBCELoss(loss_penalty_weights, from_logits=output_logits).to(device=device)
+    metric_fns = {'acc': StreamingAccuracy(), 'group_acc': StreamingGroupAccuracy()}
     optimizer = torch.optim.Adam(model.parameters(), lr=params["start_learningrate"])
+    # a trial retried after a crash continues from the checkpoint of the trial it retries. retry_history reads the
+    # system attributes of the stored (frozen) trial, the live Trial does not have them
+    frozen_trial = next(t for t in trial.study.get_trials(deepcopy=False) if t.number == trial.number)
+    retry_history = optuna.storages.RetryFailedTrialCallback.retry_history(frozen_trial)
+    trial_key = retry_history[0] if retry_history else trial.number
+    checkpoint_path = checkpoint_dir + "/" + study_name + "_trial" + str(trial_key) + ".pt"
     start = time.time()
-    score = train(train_dataloader, val_dataloader, model, loss_fn, metric_fns, optimizer, params["n_epochs"], trial)
+    try:
+        score = train(train_dataloader, trial_val_dataloader, trial_test_dataloader, model, loss_fn, metric_fns, optimizer,
+                      params["n_epochs"], trial, checkpoint_path=checkpoint_path, resume=True)
+    except optuna.exceptions.TrialPruned:
+        if os.path.isfile(checkpoint_path):
+            os.remove(checkpoint_path)
+        raise
+    # only the checkpoint of the best trial so far is kept
+    if score == lowest_val_loss:
+        os.replace(checkpoint_path, checkpoint_dir + "/" + study_name + "_best.pt")
+    elif os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
     end = time.time()
     print("Time in minutes for training "+str(params["n_epochs"])+" epochs:")
     print((end - start)/60)
@@ -512,6 +1299,10 @@ if __name__ == "__main__":
     ct = ct.replace(".", "_")
     ct = ct.replace(":", "-")
 
+    # usage: python dlds_code.py <config> [--resume]
+    # (--sweep-worker <study_name> is used by run_sweep for its worker processes)
+    resume = "--resume" in sys.argv[2:]
+    sweep_worker_study = sys.argv[sys.argv.index("--sweep-worker") + 1] if "--sweep-worker" in sys.argv else None
     if len(sys.argv)>1:
         configfilename = sys.argv[1]
         file = open("configs/"+configfilename + ".yaml", 'r')
@@ -539,10 +1330,63 @@ if __name__ == "__main__":
     p_augment = config_dict.get("p_augment", 0.5)
     n_optuna_trials = config_dict.get("n_optuna_trials", 1)
     do_tuning = config_dict.get("do_tuning", False)
+    n_parallel_trials = config_dict.get("n_parallel_trials", 1)
+    study_storage = config_dict.get("study_storage", "sqlite:///optuna_" + configfilename + ".db")
+    study_name = configfilename + "_" + ct
+    checkpoint_dir = config_dict.get("checkpoint_dir", "checkpoints")
+    checkpoint_every = config_dict.get("checkpoint_every", 1)
+    if resume and do_tuning:
+        # continue the most recent study of this config
+        summaries = [summary for summary in optuna.get_all_study_summaries(make_study_storage(), include_best_trial=False)
+                     if summary.study_name.startswith(configfilename + "_")]
+        if summaries:
+            study_name = max(summaries, key=lambda summary: summary.study_name).study_name
+            ct = study_name[len(configfilename) + 1:]
+            print("Resuming study " + study_name)
+    elif resume and os.path.isfile(checkpoint_dir + "/" + configfilename + ".pt"):
+        # keep the output file names of the interrupted run (trusted checkpoint, see load_checkpoint)
+        ct = torch.load(checkpoint_dir + "/" + configfilename + ".pt", map_location='cpu', weights_only=False)['ct']
+    if sweep_worker_study is not None:
+        study_name = sweep_worker_study
+        ct = study_name[len(configfilename) + 1:]
     depth = config_dict.get("depth", 18)
     loss_penalty_weights = config_dict.get("loss_penalty_weights", [1 for i in range(14)])
+    # attention scores json (or name of an analysed run) to take the loss penalty weights from by class name
+    attention_scores_file = config_dict.get("attention_scores_file", None)
+    if attention_scores_file is not None:
+        loss_penalty_weights = load_attention_weights(attention_scores_file)
+    # recompute the penalty weights from the validation group accuracies every n epochs (0: never)
+    attention_update_every = config_dict.get("attention_update_every", 0)
+    # sample training batches balanced over race x gender (x age) groups instead of shuffling, with group weights
+    # from the group counts ("counts") or from attention scores (json file or run name), epoch_length samples per epoch
+    use_balanced_sampler = config_dict.get("use_balanced_sampler", False)
+    sampler_weights = config_dict.get("sampler_weights", "counts")
+    sampler_age_groups = config_dict.get("sampler_age_groups", False)
+    epoch_length = config_dict.get("epoch_length", None)
     loss_name = config_dict.get("loss_name", "bce")
     lmbd = config_dict.get("lmbd", 1)
+    regularizer_momentum = config_dict.get("regularizer_momentum", 0.)
+    if attention_update_every > 0 and loss_name == "regularized_BCE":
+        # the regularized loss weights all classes equally and never reads the penalty weights
+        raise ValueError("attention_update_every has no effect with loss_name 'regularized_BCE'")
+    use_packed_images = config_dict.get("use_packed_images", False)
+    additional_heads = config_dict.get("additional_heads", [])
+    num_workers = config_dict.get("num_workers", 0)
+    prefetch_factor = config_dict.get("prefetch_factor", 2)
+    persistent_workers = config_dict.get("persistent_workers", True)
+    prefetch_depth = config_dict.get("prefetch_depth", 2)
+    augment_in_workers = config_dict.get("augment_in_workers", False)
+    precision = config_dict.get("precision", "fp32")
+    channels_last = config_dict.get("channels_last", False)
+    # softmax heads with BCELoss are not autocast-safe, so reduced precision defaults to logit heads
+    output_logits = config_dict.get("output_logits", precision != "fp32")
+    use_feature_cache = config_dict.get("use_feature_cache", False)
+    prediction_dtype = np.dtype(config_dict.get("prediction_dtype", "float16"))
+    # batch size of the final test inference, no activations are kept for backward so it can be larger
+    inference_batch_size = config_dict.get("inference_batch_size", 512)
+    feature_cache_dir = config_dict.get("feature_cache_dir", data_path + "/feature_cache")
+    if precision == "fp16" and device != "cuda":
+        print("fp16 autocast needs cuda, using bf16 on " + device)
 
     focal_alpha = 0.8
     focal_gamma = 2
@@ -561,45 +1405,68 @@ if __name__ == "__main__":
     else:
         labelfileprev = ""
 
+    dataset_kwargs = {'output_category': output_category, 'balanced': use_balanced_dataset,
+                      'additional_heads': additional_heads}
     if use_short_data_version:
-        training_data = FaceDataset(data_path + "/" + labelfileprev + "fairface_label_train.csv", data_path,
-                                    output_category=output_category, balanced=use_balanced_dataset)
-        val_data = FaceDataset(data_path + "/" + labelfileprev + "fairface_label_val.csv", data_path, output_category=output_category,
-                               balanced=use_balanced_dataset)
-        test_data = FaceDataset(data_path + "/test.csv", data_path,
-                                output_category=output_category, balanced=use_balanced_dataset)
+        annotation_files = [data_path + "/" + labelfileprev + "fairface_label_train.csv",
+                            data_path + "/" + labelfileprev + "fairface_label_val.csv", data_path + "/test.csv"]
+    else:
+        annotation_files = [data_path + "/train.csv", data_path + "/val.csv", data_path + "/test.csv"]
+    # subsets given as index files over one master annotation file (see dataloader.split_dataset), one per split
+    split_master = config_dict.get("split_master", None)
+    split_indices = config_dict.get("split_indices", None)
+    split_kwargs = [{}, {}, {}]
+    if split_master is not None and split_indices is not None:
+        annotation_files = [data_path + "/" + split_master] * 3
+        split_kwargs = [{'indices': data_path + "/" + fn} if fn is not None else {} for fn in split_indices]
+    if use_packed_images:
+        packed_prefix = config_dict.get("packed_images_prefix", data_path + "/" + labelfileprev + "packed")
+        if not os.path.isfile(packed_prefix + "_index.csv"):
+            print("Packing images into " + packed_prefix + "_images.npy")
+            pack_images(annotation_files, data_path, packed_prefix)
+        dataset_class = PackedFaceDataset
+        dataset_kwargs['packed_prefix'] = packed_prefix
     else:
-        training_data = FaceDataset(data_path+"/train.csv", data_path, output_category=output_category, balanced=use_balanced_dataset)
-        val_data = FaceDataset(data_path+"/val.csv", data_path, output_category=output_category, balanced=use_balanced_dataset)
-        test_data = FaceDataset(data_path + "/test.csv", data_path,output_category=output_category, balanced=use_balanced_dataset)
-    val_dataloader = DataLoader(val_data, batch_size=128, shuffle=False)
-    test_dataloader = DataLoader(test_data, batch_size=128, shuffle=False)
+        dataset_class = FaceDataset
+    training_data = dataset_class(annotation_files[0], data_path, **dataset_kwargs, **split_kwargs[0])
+    val_data = dataset_class(annotation_files[1], data_path, **dataset_kwargs, **split_kwargs[1])
+    test_data = dataset_class(annotation_files[2], data_path, **dataset_kwargs, **split_kwargs[2])
+    if use_data_augmentation and augment_in_workers:
+        training_data.transform = augmentation_transforms(p_augment)
+    augmenter = BatchAugmentation(p_augment).to(device=device)
+    train_sampler = make_train_sampler(training_data) if use_balanced_sampler else None
+    val_dataloader = make_dataloader(val_data, batch_size=128, shuffle=False)
+    test_dataloader = make_dataloader(test_data, batch_size=128, shuffle=False)
     lowest_val_loss = 1
-    if do_tuning:
-        study = optuna.create_study(direction="minimize", sampler=optuna.samplers.TPESampler(),
-                                    pruner=optuna.pruners.MedianPruner())
-        study.optimize(objective, n_trials=n_optuna_trials)  # -> function given by objective
-        best_trial = study.best_trial
-        for key, value in best_trial.params.items():
-            print("{}: {}".format(key, value))
+    if sweep_worker_study is not None:
+        sweep_worker(max(1, (os.cpu_count() or 1) // n_parallel_trials))
+    elif do_tuning:
+        study = run_sweep()
+        if any(t.state == optuna.trial.TrialState.COMPLETE for t in study.trials):
+            best_trial = study.best_trial
+            for key, value in best_trial.params.items():
+                print("{}: {}".format(key, value))
+        else:
+            print("No trial of study " + study.study_name + " completed, there is no best trial")
     else:
-        train_dataloader = DataLoader(training_data, batch_size=batch_size, shuffle=True)
-        print("Datasets loaded")
         #model = load_model(num_classes, layers_to_train, train_bn_params, update_bn_estimate)
-        model = FaceResNet(output_category, layers_to_train, train_bn_params, update_bn_estimate, depth).to(device=device)
+        model = build_model(layers_to_train, train_bn_params, update_bn_estimate)
         print("Model loaded")
+        train_dataloader, val_dataloader, test_dataloader = make_dataloaders(model, batch_size)
+        print("Datasets loaded")
         if loss_name=="bce":
-            loss_fn = bce_loss
+            loss_fn = PenaltyWeightedBCELoss(loss_penalty_weights, from_logits=output_logits).to(device=device)
         elif loss_name=="focal":
-            loss_fn = focal_loss
+            loss_fn = PenaltyWeightedBCELoss(loss_penalty_weights, focal_alpha, focal_gamma, output_logits).to(device=device)
         elif loss_name=="regularized_BCE":
-            loss_fn = regularized_BCE
+            loss_fn = RegularizedBCELoss(lmbd, regularizer_momentum, from_logits=output_logits).to(device=device)
         else:
             print("no valid loss")
-        metric_fns = {'acc': accuracy_fn}
+        metric_fns = {'acc': StreamingAccuracy(), 'group_acc': StreamingGroupAccuracy()}
         optimizer = torch.optim.Adam(model.parameters(), lr=start_learningrate)
         start = time.time()
-        score = train(train_dataloader, val_dataloader, model, loss_fn, metric_fns, optimizer, n_epochs)
+        score = train(train_dataloader, val_dataloader, test_dataloader, model, loss_fn, metric_fns, optimizer, n_epochs,
+                      checkpoint_path=checkpoint_dir + "/" + configfilename + ".pt", resume=resume)
         end = time.time()
         print("Time in minutes for training " + str(n_epochs) + " epochs:")
         print((end - start) / 60)
\ No newline at end of file
@@ -0,0 +1,161 @@
+import os
+import sys
+import copy
+import json
+import time
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from dlds_code import FaceDataset, collate_batched
+from dataloader import sample_indices
+from predict import load_model
+from prediction_analysis import FairnessStatistics, encode_labels_to_one_hot, get_class_names
+
+# Exports a dlds_code checkpoint for cpu inference: a traced TorchScript module and an ONNX graph that both take a
+# float (N, 3, 224, 224) batch in [0, 1] and return the class probabilities of every head. Optionally an int8
+# variant is built (static post-training quantization calibrated on a stratified slice of val.csv, or dynamic
+# quantization of the linear heads) and compared with the fp32 model per race x gender group on another slice.
+
+
+class ProbabilityModel(nn.Module):
+    # FaceResNet with probability outputs, independent of output_logits
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.to_probabilities(self.model(x))
+
+
+def export_torchscript(model, example, path):
+    # tracing records the python control flow of FaceResNet (category, heads, stages) for this model
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    traced.save(path)
+    print('Saved TorchScript model ' + path)
+    return traced
+
+
+def export_onnx(model, example, path, heads):
+    try:
+        torch.onnx.export(model, example, path, input_names=['image'], output_names=heads,
+                          dynamic_axes={'image': {0: 'batch'}, **{name: {0: 'batch'} for name in heads}})
+    except ImportError as e:
+        print('Skipping ONNX export, ' + str(e))
+        return
+    print('Saved ONNX model ' + path)
+
+
+def make_loader(data_path, output_category, additional_heads, indices, batch_size=32):
+    dataset = FaceDataset(data_path + '/val.csv', data_path, output_category=output_category,
+                          additional_heads=additional_heads, indices=indices)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_batched)
+
+
+def quantize_static(model, calibration_loader, example):
+    # fx graph mode post-training quantization: observers record activation ranges on the calibration images,
+    # convolutions, batch norms (folded) and linear layers then run in int8
+    torch.backends.quantized.engine = 'x86'
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping('x86'), example_inputs=(example,))
+    with torch.inference_mode():
+        for (x, _) in calibration_loader:
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def run_model(model, loader):
+    # probabilities per head (concatenated over the loader) and images per second
+    outputs, n_images, seconds = [], 0, 0.
+    with torch.inference_mode():
+        for (x, _) in loader:
+            start = time.perf_counter()
+            y_hat = model(x)
+            seconds += time.perf_counter() - start
+            n_images += x.size(0)
+            outputs.append([el.numpy() for el in (y_hat if type(y_hat) is tuple else (y_hat,))])
+    return [np.concatenate(el) for el in zip(*outputs)], n_images / seconds
+
+
+def fairness_statistics(outputs, heads, labels_true):
+    # predictions in the layout of prediction_analysis: gender columns first, race columns last
+    by_name = dict(zip(heads, outputs))
+    labels_pred = np.concatenate([by_name[name] for name in ['gender', 'race'] if name in by_name], axis=1)
+    return FairnessStatistics.from_one_hot(labels_pred, labels_true)
+
+
+def parity_report(model, quantized, loader, heads, path):
+    # accuracy of the fp32 and the int8 model per race x gender group, a group regresses when its int8 accuracy is
+    # more than two jackknife standard errors (of the fp32 accuracy) below the fp32 accuracy
+    labels_true = encode_labels_to_one_hot(loader.dataset.img_labels)
+    outputs_fp32, throughput_fp32 = run_model(model, loader)
+    outputs_int8, throughput_int8 = run_model(quantized, loader)
+    stats_fp32 = fairness_statistics(outputs_fp32, heads, labels_true)
+    stats_int8 = fairness_statistics(outputs_int8, heads, labels_true)
+
+    acc_fp32, acc_int8 = stats_fp32.group_accuracy(), stats_int8.group_accuracy()
+    se = stats_fp32.jackknife()['group_accuracy']
+    # fraction of images for which both models predict the same class on every head
+    agreement = np.mean(np.all([np.argmax(a, axis=1) == np.argmax(b, axis=1)
+                                for a, b in zip(outputs_fp32, outputs_int8)], axis=0))
+    report = pd.DataFrame({'group': get_class_names('race'), 'n_samples': stats_fp32.group_sizes(),
+                           'accuracy_fp32': acc_fp32, 'accuracy_int8': acc_int8, 'difference': acc_int8 - acc_fp32,
+                           'se_fp32': se, 'regressed': acc_int8 < acc_fp32 - 2 * se})
+    report.to_csv(path + '.csv', index=False)
+    summary = {'n_samples': stats_fp32.n_samples, 'prediction_agreement': float(agreement),
+               'accuracy_fp32': float(acc_fp32.mean()), 'accuracy_int8': float(acc_int8.mean()),
+               'throughput_fp32': throughput_fp32, 'throughput_int8': throughput_int8,
+               'regressed_groups': report['group'][report['regressed']].tolist()}
+    with open(path + '.json', 'w') as f:
+        json.dump(summary, f, indent=1)
+    print(report.round(4).to_string(index=False))
+    print(json.dumps(summary, indent=1))
+    return report, summary
+
+
+def export(checkpoint_path, data_path, out_dir='exported', quantize=None, n_calibration=512, n_parity=2048,
+           seed=0):
+    torch.set_grad_enabled(False)
+    model, state = load_model(checkpoint_path, 'cpu')
+    model = ProbabilityModel(model.eval())
+    heads = model.model.output_heads()
+    if quantize is not None and not {'race', 'gender'} <= set(heads):
+        # the parity report compares the models per race x gender group
+        raise ValueError('Quantization needs a model with race and gender heads for the parity report, '
+                         + checkpoint_path + ' has ' + ', '.join(heads))
+    name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+    os.makedirs(out_dir, exist_ok=True)
+    example = torch.rand(1, 3, 224, 224)
+
+    export_torchscript(model, example, os.path.join(out_dir, name + '.pt'))
+    export_onnx(model, example, os.path.join(out_dir, name + '.onnx'), heads)
+    if quantize is None:
+        return
+
+    # calibration and parity images are disjoint stratified slices of val.csv
+    val_labels = pd.read_csv(data_path + '/val.csv')
+    calibration_idx = sample_indices(val_labels, n_calibration, seed=seed)
+    rest = np.setdiff1d(np.arange(len(val_labels)), calibration_idx)
+    parity_idx = rest[sample_indices(val_labels.iloc[rest], n_parity, seed=seed)]
+    output_category = state['model_config']['output_category']
+    additional_heads = state['model_config']['additional_heads']
+    if quantize == 'static':
+        quantized = quantize_static(model, make_loader(data_path, output_category, additional_heads, calibration_idx),
+                                    example)
+    else:
+        # only the linear heads are quantized, the convolutions stay in fp32
+        quantized = quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+    export_torchscript(quantized, example, os.path.join(out_dir, name + '_int8.pt'))
+    parity_report(model, quantized, make_loader(data_path, output_category, additional_heads, parity_idx), heads,
+                  os.path.join(out_dir, name + '_int8_parity'))
+
+
+if __name__ == "__main__":
+    # usage: python export_model.py <checkpoint.pt> <data_path> [--out DIR] [--quantize static|dynamic]
+    #        [--calibration N] [--parity N]
+    options = {sys.argv[i]: sys.argv[i + 1] for i in range(3, len(sys.argv) - 1, 2)}
+    export(sys.argv[1], sys.argv[2], out_dir=options.get('--out', 'exported'), quantize=options.get('--quantize'),
+           n_calibration=int(options.get('--calibration', 512)), n_parity=int(options.get('--parity', 2048)))
@@ -0,0 +1,85 @@
+import sys
+import json
+import time
+import asyncio
+import numpy as np
+from predict import list_images
+
+# Load generator for serve.py: concurrent keep-alive clients send images to /predict/<model> and the client side
+# p50/p99 latency and throughput are reported for every batching deadline (set through /config).
+
+
+async def http_request(reader, writer, method, path, body=b''):
+    writer.write(b'%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n'
+                 % (method.encode(), path.encode(), len(body)) + body)
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {k.strip().lower(): v.strip() for k, v in (l.split(':', 1) for l in lines[1:] if ':' in l)}
+    data = await reader.readexactly(int(headers.get('content-length', 0)))
+    return int(lines[0].split(' ')[1]), json.loads(data)
+
+
+async def request(host, port, method, path, body=b''):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return await http_request(reader, writer, method, path, body)
+    finally:
+        writer.close()
+
+
+async def client(host, port, model, images, n_requests, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in range(n_requests):
+            start = time.perf_counter()
+            status, _ = await http_request(reader, writer, 'POST', '/predict/' + model, images[i % len(images)])
+            if status != 200:
+                raise RuntimeError('Request failed with status ' + str(status))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, model, images, concurrency, n_requests):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, model, images, n_requests // concurrency, latencies)
+                           for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {'requests': len(latencies), 'throughput': len(latencies) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99))}
+
+
+async def benchmark(source, host='127.0.0.1', port=8000, model=None, concurrency=32, n_requests=2000,
+                    deadlines=(0., 2., 5., 10.), max_batch=None, n_images=256):
+    files, img_dir = list_images(source)
+    images = []
+    for fn in files[:n_images]:
+        with open(img_dir + '/' + fn, 'rb') as f:
+            images.append(f.read())
+    if model is None:
+        _, models = await request(host, port, 'GET', '/models')
+        model = next(iter(models))
+    print('deadline_ms  max_batch  throughput  p50_ms  p99_ms  mean_batch_size')
+    for deadline in deadlines:
+        config = {'max_wait_ms': deadline, **({'max_batch': max_batch} if max_batch is not None else {})}
+        await request(host, port, 'POST', '/config', json.dumps(config).encode())
+        await run_load(host, port, model, images, concurrency, min(n_requests, 4 * concurrency))  # warm up
+        await request(host, port, 'POST', '/config', json.dumps(config).encode())  # resets the server counters
+        result = await run_load(host, port, model, images, concurrency, n_requests)
+        _, stats = await request(host, port, 'GET', '/stats')
+        print(f"{deadline:11.1f}  {stats[model]['max_batch']:9d}  {result['throughput']:10.1f}  "
+              f"{result['p50_ms']:6.1f}  {result['p99_ms']:6.1f}  {stats[model]['mean_batch_size']:15.1f}")
+
+
+if __name__ == "__main__":
+    # usage: python loadgen.py <image folder or csv> [--port N] [--model NAME] [--concurrency N] [--requests N]
+    #        [--deadlines 0,2,5,10] [--max-batch N]
+    options = {sys.argv[i]: sys.argv[i + 1] for i in range(2, len(sys.argv) - 1, 2)}
+    asyncio.run(benchmark(sys.argv[1], port=int(options.get('--port', 8000)), model=options.get('--model'),
+                          concurrency=int(options.get('--concurrency', 32)),
+                          n_requests=int(options.get('--requests', 2000)),
+                          deadlines=[float(d) for d in options.get('--deadlines', '0,2,5,10').split(',')],
+                          max_batch=int(options['--max-batch']) if '--max-batch' in options else None))
@@ -0,0 +1,117 @@
+import os
+import sys
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import torch
+from torchvision.io import read_image, ImageReadMode
+from torchvision.transforms.functional import resize
+from tqdm import tqdm
+from dlds_code import FaceResNet, LABEL_NAMES
+from prediction_store import PredictionWriter, split_hash
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def list_images(source, img_dir=None):
+    # file names (relative to img_dir) of a csv with a 'file' column or of all images below a folder
+    if os.path.isfile(source):
+        img_dir = os.path.dirname(source) if img_dir is None else img_dir
+        return list(pd.read_csv(source)['file']), img_dir
+    files = []
+    for root, _, names in os.walk(source):
+        files += [os.path.relpath(os.path.join(root, name), source) for name in names
+                  if name.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(files), source
+
+
+def load_model(checkpoint_path, device):
+    # rebuilds the FaceResNet of a checkpoint written by dlds_code from its model_config, without pretrained weights
+    state = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    model_config = state['model_config']
+    model = FaceResNet(model_config['output_category'], depth=model_config['depth'],
+                       output_logits=model_config['output_logits'], pretrained=False)
+    for name in model_config['additional_heads']:
+        model.add_head(name, len(LABEL_NAMES[name]))
+    model.load_state_dict(state['model'])
+    model.eval()
+    return model.to(device=device), state
+
+
+def decode(path, image_size=224):
+    image = read_image(path, mode=ImageReadMode.RGB)
+    if image.shape[1:] != (image_size, image_size):
+        image = resize(image, [image_size, image_size], antialias=True)
+    return image
+
+
+def read_batches(paths, batch_size, n_threads, max_pending_batches=4):
+    # decodes the images in a thread pool, at most max_pending_batches batches are decoded ahead of the model,
+    # so memory stays bounded however many files there are
+    with ThreadPoolExecutor(n_threads) as pool:
+        pending = collections.deque()
+        for start in range(0, len(paths), batch_size):
+            pending.append(pool.map(decode, paths[start:start + batch_size]))
+            if len(pending) > max_pending_batches:
+                yield torch.stack(list(pending.popleft()))
+        while pending:
+            yield torch.stack(list(pending.popleft()))
+
+
+def predict_batch(model, images, device, max_batch):
+    # probabilities per head for a uint8 batch, run in chunks of max_batch images. On a cuda out of memory error
+    # max_batch is halved, the returned max_batch is used for all following batches
+    outputs = []
+    start = 0
+    while start < len(images):
+        try:
+            with torch.inference_mode():
+                x = images[start:start + max_batch].to(device=device, non_blocking=True).float() / 255
+                y_hat = model.to_probabilities(model(x))
+        except torch.cuda.OutOfMemoryError:
+            if max_batch == 1:
+                raise
+            torch.cuda.empty_cache()
+            max_batch //= 2
+            print('Out of memory, reducing the batch size to ' + str(max_batch))
+            continue
+        outputs.append([el.float().cpu().numpy() for el in (y_hat if type(y_hat) is tuple else (y_hat,))])
+        start += len(x)
+    return [np.concatenate(el) for el in zip(*outputs)], max_batch
+
+
+def predict(checkpoint_path, source, out_path, img_dir=None, batch_size=256, n_threads=8, dtype=np.float16):
+    # scores every image of source with the model of the checkpoint into the prediction store out_path, the sample
+    # ids index the file list saved as files.csv in the store
+    device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
+    model, state = load_model(checkpoint_path, device)
+    files, img_dir = list_images(source, img_dir)
+    heads = model.output_heads()
+    metadata = {'config': os.path.splitext(os.path.basename(checkpoint_path))[0], 'timestamp': state.get('ct'),
+                'checkpoint': checkpoint_path,
+                'split': 'inference', 'split_hash': split_hash(files), 'annotations_file': source,
+                'kind': 'predictions'}
+    writer = PredictionWriter(out_path, len(files), {name: len(LABEL_NAMES[name]) for name in heads}, metadata, dtype)
+    paths = [os.path.join(img_dir, fn) for fn in files]
+    max_batch = batch_size
+    try:
+        with tqdm(total=len(files)) as progress:
+            for images in read_batches(paths, batch_size, n_threads):
+                outputs, max_batch = predict_batch(model, images, device, max_batch)
+                writer.write(outputs)
+                progress.update(len(images))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    pd.DataFrame({'file': files}).to_csv(os.path.join(out_path, 'files.csv'), index_label='sample_id')
+
+
+if __name__ == "__main__":
+    # usage: python predict.py <checkpoint.pt> <image folder or csv> <out.preds> [--img-dir DIR] [--batch-size N]
+    #        [--threads N]
+    args = sys.argv[1:]
+    options = {args[i]: args[i + 1] for i in range(3, len(args) - 1, 2)}
+    predict(args[0], args[1], args[2], img_dir=options.get('--img-dir'),
+            batch_size=int(options.get('--batch-size', 256)), n_threads=int(options.get('--threads', 8)))
@@ -6,77 +6,194 @@ import torch
 import os
 from tqdm import tqdm
 import json
+import io
+import pickle
+import hashlib
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from prediction_store import is_prediction_store, load_predictions, split_hash
+
+
+GENDER_NAMES = ['Male', 'Female']
+RACE_NAMES = ['Black', 'East Asian', 'Indian', 'Latino_Hispanic', 'Middle Eastern', 'Southeast Asian', 'White']
+
+
+def get_class_names(sort_after: str = 'race'):
+    if sort_after == 'race':
+        return [f'{r_n} {g_n}' for r_n in RACE_NAMES for g_n in GENDER_NAMES]
+    return [f'{r_n} {g_n}' for g_n in GENDER_NAMES for r_n in RACE_NAMES]
+
+
+def attention_scores(group_accuracy: np.array):
+    # attention score of every group: 2 ** ((mean - acc) / (2 * std))
+    # over the group accuracies, so groups that are one std below the mean get weight sqrt(2). The groups are the
+    # last axis, leading axes (e.g. bootstrap resamples) are scored independently. When all groups have the same
+    # accuracy (std 0) every group gets weight 1
+    mean = group_accuracy.mean(axis=-1, keepdims=True)
+    std = group_accuracy.std(axis=-1, keepdims=True)
+    return np.where(std > 0, 2 ** ((mean - group_accuracy) / (2 * np.where(std > 0, std, 1))), 1.)
+
+
+class FairnessStatistics:
+    # all fairness numbers of a prediction file, without any plotting. Everything is derived from one
+    # race x gender x gender-correct x race-correct contingency tensor and one confusion matrix, each built with a
+    # single bincount over integer labels
+    def __init__(self, race_true: np.array, gender_true: np.array, race_pred: np.array, gender_pred: np.array):
+        n_races, n_genders = len(RACE_NAMES), len(GENDER_NAMES)
+        gender_correct = (gender_pred == gender_true).astype(np.int64)
+        race_correct = (race_pred == race_true).astype(np.int64)
+        idx = ((race_true * n_genders + gender_true) * 2 + gender_correct) * 2 + race_correct
+        self.counts = np.bincount(idx, minlength=n_races * n_genders * 4).reshape(n_races, n_genders, 2, 2)
+        # classes in race-major order (2*race+gender), rows: true class, columns: predicted class
+        k = n_races * n_genders
+        class_true, class_pred = race_true * n_genders + gender_true, race_pred * n_genders + gender_pred
+        self.confusion_race_major = np.bincount(class_true * k + class_pred, minlength=k * k).reshape(k, k)
+        self.n_samples = len(race_true)
+
+    @classmethod
+    def from_one_hot(cls, labels_pred: np.array, labels_true: np.array):
+        # labels with the gender columns first and the race columns last, predictions may contain only one of both,
+        # then the true labels are used for the other
+        assert labels_pred.shape[1] in [2, 7, 9], f'Unexpected prediction label size {labels_pred.shape[1]}'
+        gender_true = np.argmax(labels_true[:, :2], axis=1)
+        race_true = np.argmax(labels_true[:, -7:], axis=1)
+        gender_pred = np.argmax(labels_pred[:, :2], axis=1) if labels_pred.shape[1] != 7 else gender_true
+        race_pred = np.argmax(labels_pred[:, -7:], axis=1) if labels_pred.shape[1] != 2 else race_true
+        return cls(race_true, gender_true, race_pred, gender_pred)
+
+    def by_class(self, values: np.array, sort_after: str = 'race'):
+        # flattens a (race, gender, ...) array into the class order of get_class_names(sort_after)
+        if sort_after != 'race':
+            values = values.swapaxes(0, 1)
+        return values.reshape(len(RACE_NAMES) * len(GENDER_NAMES), *values.shape[2:])
+
+    def group_values(self, gender: bool, race: bool, sort_after: str = 'race'):
+        # number of samples per class where the gender (race) prediction is correct == gender (race)
+        return self.by_class(self.counts[:, :, int(gender), int(race)], sort_after)
+
+    def group_sizes(self, sort_after: str = 'race'):
+        return self.by_class(self.counts.sum(axis=(2, 3)), sort_after)
+
+    def tables(self, sort_after: str = 'race', normalize: bool = False):
+        # stacked bar tables: gender (both correct, only gender correct, incorrect) and
+        # race (both correct, only race correct, incorrect), one row per class
+        both = self.group_values(True, True, sort_after)
+        gender_only = self.group_values(True, False, sort_after)
+        race_only = self.group_values(False, True, sort_after)
+        none = self.group_values(False, False, sort_after)
+        gender = np.stack([both, gender_only, race_only + none], axis=1).astype(float)
+        race = np.stack([both, race_only, gender_only + none], axis=1).astype(float)
+        if normalize:
+            gender = 100 * gender / np.maximum(gender.sum(axis=1, keepdims=True), 1)
+            race = 100 * race / np.maximum(race.sum(axis=1, keepdims=True), 1)
+        return gender, race
+
+    def group_accuracy(self, sort_after: str = 'race'):
+        # fraction of every class with gender and race predicted correctly
+        return self.group_values(True, True, sort_after) / np.maximum(self.group_sizes(sort_after), 1)
+
+    def attention_scores(self, sort_after: str = 'race'):
+        return attention_scores(100 * self.group_accuracy(sort_after))
+
+    def derived(self, group_accuracy: np.array):
+        # the statistics that get confidence intervals, computed along the last (group) axis
+        return {'group_accuracy': group_accuracy,
+                'accuracy_gap': group_accuracy.max(axis=-1) - group_accuracy.min(axis=-1),
+                'attention_scores': attention_scores(100 * group_accuracy)}
+
+    def bootstrap(self, n_boot: int = 2000, alpha: float = 0.05, sort_after: str = 'race', seed: int = 0):
+        # percentile intervals of a bootstrap stratified by group. Resampling the correctness vector of a group of
+        # n samples only changes its number of correct samples, which is binomial(n, acc), so all resamples of all
+        # groups are drawn as one (n_boot, groups) array
+        rng = np.random.default_rng(seed)
+        n = self.group_sizes(sort_after)
+        acc_boot = rng.binomial(n, self.group_accuracy(sort_after), size=(n_boot, len(n))) / np.maximum(n, 1)
+        return {name: np.quantile(values, [alpha / 2, 1 - alpha / 2], axis=0)
+                for name, values in self.derived(acc_boot).items()}
+
+    def jackknife(self, sort_after: str = 'race'):
+        # standard errors of the leave-one-out jackknife over all samples, in closed form: leaving out a correct
+        # (incorrect) sample of group g only changes acc_g to (c - 1) / (n - 1) (c / (n - 1)), so there are just
+        # 2 * groups distinct leave-one-out statistics, weighted by how many samples produce them
+        n = self.group_sizes(sort_after)
+        c = self.group_values(True, True, sort_after)
+        k = len(n)
+        loo = np.tile(c / np.maximum(n, 1), (2 * k, 1))
+        loo[np.arange(k), np.arange(k)] = (c - 1) / np.maximum(n - 1, 1)
+        loo[k + np.arange(k), np.arange(k)] = c / np.maximum(n - 1, 1)
+        weights = np.concatenate([c, n - c])
+        keep = weights > 0
+        loo, weights = loo[keep], weights[keep, None]
+        n_total = weights.sum()
+        standard_errors = {}
+        for name, values in self.derived(loo).items():
+            values = values.reshape(len(loo), -1)
+            mean = (weights * values).sum(axis=0) / n_total
+            variance = (n_total - 1) / n_total * (weights * (values - mean) ** 2).sum(axis=0)
+            standard_errors[name] = np.sqrt(variance).reshape(np.shape(values[0]) if values.shape[1] > 1 else ())
+        return standard_errors
+
+    def confidence_intervals(self, n_boot: int = 2000, alpha: float = 0.05, sort_after: str = 'race', seed: int = 0):
+        # estimate, bootstrap interval and jackknife standard error of the per-class accuracies, the accuracy gap
+        # and the attention scores, as plain dicts
+        class_names = get_class_names(sort_after)
+        estimates = self.derived(self.group_accuracy(sort_after))
+        intervals = self.bootstrap(n_boot, alpha, sort_after, seed)
+        standard_errors = self.jackknife(sort_after)
+        result = {'n_boot': n_boot, 'alpha': alpha}
+        for name, estimate in estimates.items():
+            if np.ndim(estimate) == 0:
+                result[name] = {'estimate': float(estimate), 'ci': intervals[name].tolist(),
+                                'se': float(standard_errors[name])}
+            else:
+                result[name] = {class_name: {'estimate': float(estimate[i]), 'ci': intervals[name][:, i].tolist(),
+                                             'se': float(standard_errors[name][i])}
+                                for i, class_name in enumerate(class_names)}
+        return result
+
+    def confusion(self, sort_after: str = 'race'):
+        if sort_after == 'race':
+            return self.confusion_race_major
+        k = len(RACE_NAMES) * len(GENDER_NAMES)
+        order = np.arange(k).reshape(len(RACE_NAMES), len(GENDER_NAMES)).T.reshape(-1)
+        return self.confusion_race_major[np.ix_(order, order)]
+
+    def summary(self, sort_after: str = 'race'):
+        # per-class accuracies and attention scores as plain dicts
+        class_names = get_class_names(sort_after)
+        return {'n_samples': self.n_samples,
+                'group_accuracy': dict(zip(class_names, self.group_accuracy(sort_after).tolist())),
+                'attention_scores': dict(zip(class_names, self.attention_scores(sort_after).tolist()))}
 
 
 class PredictionVisualization:
     def __init__(self, labels_pred, labels_true, sort_after: str = 'race'):
         assert sort_after == 'gender' or sort_after == 'race', f"Choose 'gender' or 'race' as sort_after"
         self.sort_after = sort_after
-        self.gender_names = ['Male', 'Female']
-        self.race_names = ['Black', 'East Asian', 'Indian', 'Latino_Hispanic', 'Middle Eastern', 'Southeast Asian', 'White']
+        self.gender_names = GENDER_NAMES
+        self.race_names = RACE_NAMES
         self.class_names = self.get_class_names()
-        self.pred = self.get_labels_dict(labels_pred, labels_true)
-        self.true = self.get_labels_dict(labels_true, labels_true)
-        self.df = pd.DataFrame(list(zip(self.pred['gender_name'], self.pred['race_name'],
-                                        self.true['gender_name'], self.true['race_name'])),
-                               columns=['gender_pred', 'race_pred', 'gender_true', 'race_true'])
-
-    def get_labels_dict(self, labels, labels_true):
-        assert labels[0].size in [2, 7, 9], f'Unexpected prediction label size {labels[0].size}'
-        if labels[0].size == 2:
-            # if race predictions are missing use true race labels
-            race_labels, race_name = self.get_labels(labels_true, mode='race')
-            gender_labels, gender_name = self.get_labels(labels, mode='gender')
-        elif labels[0].size == 7:
-            # if gender predictions are missing use true gender labels
-            race_labels, race_name = self.get_labels(labels, mode='race')
-            gender_labels, gender_name = self.get_labels(labels_true, mode='gender')
-        else:
-            race_labels, race_name = self.get_labels(labels, mode='race')
-            gender_labels, gender_name = self.get_labels(labels, mode='gender')
-        if self.sort_after == 'race':
-            class_labels = len(self.gender_names) * race_labels + gender_labels
-        else:
-            class_labels = len(self.race_names) * gender_labels + race_labels
-        return {'gender_labels': gender_labels, 'race_labels': race_labels,
-                'gender_name': gender_name, 'race_name': race_name,
-                'class_labels': class_labels}
-
-    def get_labels(self, labels_one_hot: np.array, mode):
-        if mode == 'gender':
-            gender_labels = np.argmax(labels_one_hot[:, :2], axis=1)
-            gender_name = [self.gender_names[idx] for idx in gender_labels]
-            return gender_labels, gender_name
-        elif mode == 'race':
-            race_labels = np.argmax(labels_one_hot[:, -7:], axis=1)
-            race_name = [self.race_names[idx] for idx in race_labels]
-            return race_labels, race_name
-        else:
-            raise ValueError(f'Wrong mode {mode}')
+        self.stats = FairnessStatistics.from_one_hot(labels_pred, labels_true)
 
     def get_class_names(self):
-        if self.sort_after == 'race':
-            class_names = [f'{r_n} {g_n}' for r_n in self.race_names for g_n in self.gender_names]
-        else:
-            class_names = [f'{r_n} {g_n}' for g_n in self.gender_names for r_n in self.race_names]
-        return class_names
+        return get_class_names(self.sort_after)
 
     def plot_histogram(self, fn:str = None, override=False):
         if os.path.isfile(f'figs/histo_1d_{fn}.png') and os.path.isfile(f'figs/histo_2d_{fn}.png') and not override:
             return
 
-        labels_pred, labels_true, classnames = self.pred['class_labels'], self.true['class_labels'], self.class_names
+        confusion, classnames = self.stats.confusion(self.sort_after), self.class_names
         K = len(classnames)
 
         # 2d histogram
         fig, ax = plt.subplots(figsize=(10, 10))
         plt.subplots_adjust(left=0.32, bottom=0.32)
         ax.set_title('Predicted vs true labels')
-        ax.hist2d(labels_true, labels_pred, bins=K)
+        ax.pcolormesh(confusion.T)
         ax.set_xlabel('True labels')
-        ax.set_xticks([0.5 + k * ((K-1)/K) for k in range(K)], classnames, rotation=90)
+        ax.set_xticks([0.5 + k for k in range(K)], classnames, rotation=90)
         ax.set_ylabel('Predicted labels')
-        ax.set_yticks([0.5 + k * ((K-1)/K) for k in range(K)], classnames)
+        ax.set_yticks([0.5 + k for k in range(K)], classnames)
         if fn is None:
             plt.show()
         else:
@@ -85,23 +202,18 @@ class PredictionVisualization:
         plt.close(fig)
 
         # 1d histogram
-        correct_labels = []
-        incorrect_labels = []
-        for label_true, label_pred in zip(labels_true, labels_pred):
-            if label_true == label_pred:
-                correct_labels.append(label_true)
-            else:
-                incorrect_labels.append(label_true)
+        correct_labels = np.diag(confusion)
+        incorrect_labels = confusion.sum(axis=1) - correct_labels
 
         # Creating histogram
         fig, ax = plt.subplots(2, 1, figsize=(10, 10))
         plt.subplots_adjust(hspace=1, top=0.95, bottom=0.27)
-        ax[0].hist(correct_labels, color='green', bins=K)
+        ax[0].bar(range(K), correct_labels, color='green')
         ax[0].set_title('Correctly classified labels')
-        ax[0].set_xticks([0.5 + k * ((K-1)/K) for k in range(K)], classnames, rotation=60, ha='right')
-        ax[1].hist(incorrect_labels, color='red', bins=K)
+        ax[0].set_xticks(range(K), classnames, rotation=60, ha='right')
+        ax[1].bar(range(K), incorrect_labels, color='red')
         ax[1].set_title('Incorrectly classified labels')
-        ax[1].set_xticks([0.5 + k * ((K-1)/K) for k in range(K)], classnames, rotation=60, ha='right')
+        ax[1].set_xticks(range(K), classnames, rotation=60, ha='right')
         for a in ax:
             for container in a.containers:
                 a.bar_label(container)
@@ -116,28 +228,18 @@ class PredictionVisualization:
         if os.path.isfile(f'figs/plot_normalize_{normalize}_{fn}.png') and not override:
             return
 
-        gender_and_race_correct = self.get_gender_and_race_values(gender=True, race=True)
-        gender_correct = self.get_gender_and_race_values(gender=True, race=False)
-        race_correct = self.get_gender_and_race_values(gender=False, race=True)
-        none_correct = self.get_gender_and_race_values(gender=False, race=False)
-        race_and_none = {key: race_correct[key] + none_correct[key] for key in race_correct}
-        gender_and_none = {key: gender_correct[key] + none_correct[key] for key in gender_correct}
-        gender = {key: [d[key] for d in [gender_and_race_correct, gender_correct, race_and_none]] for key in
-                  gender_and_race_correct}
-        race = {key: [d[key] for d in [gender_and_race_correct, race_correct, gender_and_none]] for key in
-                gender_and_race_correct}
-
-        df_gender = pd.DataFrame.from_dict(gender, orient='index',
-                                           columns=['Gender and Race correct', 'Gender correct', 'Incorrect'])
-        df_race = pd.DataFrame.from_dict(race, orient='index',
-                                         columns=['Gender and Race correct', 'Race correct', 'Incorrect'])
+        gender, race = self.stats.tables(self.sort_after, normalize=normalize)
+        df_gender = pd.DataFrame(gender, index=self.class_names,
+                                 columns=['Gender and Race correct', 'Gender correct', 'Incorrect'])
+        df_race = pd.DataFrame(race, index=self.class_names,
+                               columns=['Gender and Race correct', 'Race correct', 'Incorrect'])
 
         if normalize:
-            df_gender = df_gender.div(df_gender.sum(axis=1) * 0.01, axis=0).round(1)
-            df_race = df_race.div(df_race.sum(axis=1) * 0.01, axis=0).round(1)
+            df_gender = df_gender.round(1)
+            df_race = df_race.round(1)
 
             fig, axes = plt.subplots(1, 2, figsize=(12, 7))
-            title = f'Gender and Race classification visualization\nSize of dataset: {self.df.shape[0]}'
+            title = f'Gender and Race classification visualization\nSize of dataset: {self.stats.n_samples}'
             plt.suptitle(title)
             plt.subplots_adjust(wspace=0.5, left=0.16, right=0.98)
             for ax, df, name in zip(axes, [df_gender, df_race], ['Gender', 'Race']):
@@ -154,16 +256,13 @@ class PredictionVisualization:
                             ax.bar_label(container, label_type='center')
                 ax.set_ylim(bottom=-5)
 
-            mean = df_gender.values[:, :1].sum(axis=1).mean()
-            std = df_gender.values[:, :1].sum(axis=1).std()
-            attention_scores = 2 ** ((mean - df_gender.values[:, :1].sum(axis=1)) / (2 * std))
-            attention_dict = {key: value for key, value in zip(self.class_names, attention_scores)}
+            attention_dict = dict(zip(self.class_names, self.stats.attention_scores(self.sort_after).tolist()))
             with open(f"attention_scores/attention_scores_{fn}.json", "w") as f:
                 json.dump(attention_dict, f)
 
         else:
             fig, axes = plt.subplots(1, 2, figsize=(12, 6))
-            title = f'Gender and Race classification visualization\nSize of dataset: {self.df.shape[0]}'
+            title = f'Gender and Race classification visualization\nSize of dataset: {self.stats.n_samples}'
             plt.suptitle(title)
             plt.subplots_adjust(wspace=0.5, left=0.16, right=0.98)
             for ax, df, name in zip(axes, [df_gender, df_race], ['Gender', 'Race']):
@@ -182,35 +281,75 @@ class PredictionVisualization:
         plt.close(fig)
 
     def get_gender_and_race_values(self, gender: bool, race: bool):
-        if self.sort_after == 'race':
-            return {f'{r} {g}': len(self.df[((self.df['gender_true'] == self.df['gender_pred']) == gender) &
-                                            (self.df['gender_true'] == g) &
-                                            ((self.df['race_true'] == self.df['race_pred']) == race) &
-                                            (self.df['race_true'] == r)])
-                    for r in self.race_names for g in self.gender_names}
-        else:
-            return {f'{r} {g}': len(self.df[((self.df['gender_true'] == self.df['gender_pred']) == gender) &
-                                            (self.df['gender_true'] == g) &
-                                            ((self.df['race_true'] == self.df['race_pred']) == race) &
-                                            (self.df['race_true'] == r)])
-                    for g in self.gender_names for r in self.race_names}
-
-
-def encode_labels_to_one_hot(labels_from_csv: pd.DataFrame):
-    gender_names = ['Male', 'Female']
-    race_names = ['Black', 'East Asian', 'Indian', 'Latino_Hispanic', 'Middle Eastern', 'Southeast Asian', 'White']
-
-    gender = labels_from_csv.get('gender')
-    race = labels_from_csv.get('race')
-
-    gender_idx = [gender_names.index(g) for g in gender]
-    race_idx = [race_names.index(r) for r in race]
-
-    labels_true_gender_one_hot = pd.get_dummies(gender_idx)
-    labels_true_race_one_hot = pd.get_dummies(race_idx)
-    labels_true_one_hot = pd.concat([labels_true_gender_one_hot, labels_true_race_one_hot], axis=1).to_numpy()
-
-    np.save('val_True_gender_race_one_hot', labels_true_one_hot)
+        values = self.stats.group_values(gender, race, self.sort_after)
+        return {name: int(value) for name, value in zip(self.class_names, values)}
+
+
+def encode_labels_to_one_hot(labels_from_csv: pd.DataFrame, fn: str = None):
+    gender_idx = pd.Categorical(labels_from_csv['gender'], categories=GENDER_NAMES).codes
+    race_idx = pd.Categorical(labels_from_csv['race'], categories=RACE_NAMES).codes
+    assert (gender_idx >= 0).all() and (race_idx >= 0).all(), 'Unknown gender or race label'
+
+    labels_true_one_hot = np.concatenate([np.eye(len(GENDER_NAMES), dtype=np.uint8)[gender_idx],
+                                          np.eye(len(RACE_NAMES), dtype=np.uint8)[race_idx]], axis=1)
+    if fn is not None:
+        np.save(fn, labels_true_one_hot)
+    return labels_true_one_hot
+
+
+class GroundTruth:
+    # one-hot ground truth of the known splits, looked up by the hash of the split's file list and encoded only
+    # once per analysis run
+    def __init__(self, annotation_files=('test.csv', 'test_True.csv', 'val.csv', 'val_True.csv')):
+        self.annotation_files = annotation_files
+        self.labels = {}  # split hash -> labels of the annotation file
+        self.one_hot = {}  # split hash -> one-hot array
+
+    def index(self):
+        if not self.labels:
+            for fn in self.annotation_files:
+                labels = pd.read_csv(fn)
+                self.labels[split_hash(labels['file'])] = labels
+
+    def get(self, hash: str = None, n_samples: int = None):
+        # legacy prediction files without a hash are matched by their number of samples
+        self.index()
+        if hash is None:
+            matches = [h for h, labels in self.labels.items() if labels.shape[0] == n_samples]
+            if len(matches) != 1:
+                raise ValueError(f'Size of Prediction {n_samples} unknown')
+            hash = matches[0]
+        if hash not in self.labels:
+            raise ValueError(f'No ground truth for split hash {hash}')
+        if hash not in self.one_hot:
+            self.one_hot[hash] = encode_labels_to_one_hot(self.labels[hash])
+        return self.one_hot[hash]
+
+
+class CPUUnpickler(pickle.Unpickler):
+    # legacy prediction pickles contain tensors of the device they were saved on, load them onto the cpu
+    def find_class(self, module, name):
+        if module == 'torch.storage' and name == '_load_from_bytes':
+            return lambda b: torch.load(io.BytesIO(b), map_location='cpu', weights_only=False)
+        return super().find_class(module, name)
+
+
+def load_prediction_file(path):
+    # returns the predictions of a prediction store or of a legacy pickle as one array with the gender columns
+    # first and the race columns last, the layout PredictionVisualization expects, and the store's metadata
+    # (empty for legacy pickles)
+    if is_prediction_store(path):
+        meta, heads, sample_ids = load_predictions(path)
+        labels_pred = np.concatenate([heads[name] for name in ['gender', 'race'] if name in heads], axis=1)
+        if np.any(np.diff(sample_ids) < 0):
+            labels_pred = labels_pred[np.argsort(sample_ids)]
+        return labels_pred.astype(np.float32), meta
+    with open(path, 'rb') as f:
+        labels_pred = CPUUnpickler(f).load()
+    if isinstance(labels_pred[0], tuple):
+        for i, label in enumerate(labels_pred):
+            labels_pred[i] = torch.concat(list((label[1], label[0])), dim=1)
+    return torch.concat(list(labels_pred)).cpu().data.numpy(), {}
 
 
 def get_sample_data(n_samples=1000, n_genders=2, n_races=7):
@@ -223,43 +362,127 @@ def get_sample_data(n_samples=1000, n_genders=2, n_races=7):
     return labels_pred_one_hot, labels_true_one_hot
 
 
-if __name__ == "__main__":
-    for fn in tqdm(os.listdir('predictions')):
-        if fn.startswith('predictions') or fn.startswith('val_predictions'):
-            pass
-        else:
-            continue
-        fn_pred = f"predictions/{fn}"
-        labels_pred = np.load(fn_pred, allow_pickle=True)
-        if isinstance(labels_pred[0], tuple):
-            for i, label in enumerate(labels_pred):
-                labels_pred[i] = torch.concat(list((label[1], label[0])), dim=1)
-
-        labels_pred = torch.concat(labels_pred).cpu().data.numpy()
-
-        # annotations_file = 'val_True.csv'
-        # labels_from_csv = pd.read_csv(annotations_file)
-        # labels_true = encode_labels_to_one_hot(labels_from_csv)
-
-        if labels_pred.shape[0] == 5162:
-            labels_true = np.load('groundtruth/test_True_gender_race_one_hot.npy')
-        elif labels_pred.shape[0] == 10954:
-            labels_true = np.load('groundtruth/test_gender_race_one_hot.npy')
-        elif labels_pred.shape[0] == 5031:
-            labels_true = np.load('groundtruth/val_True_gender_race_one_hot.npy')
-        elif labels_pred.shape[0] == 10841:
-            labels_true = np.load('groundtruth/val_gender_race_one_hot.npy')
-        else:
-            raise ValueError(f'Size of Prediction {labels_pred.shape[0]} unknown')
-
-        # create sample data
-        # labels_pred, labels_true = get_sample_data()
+# batch analysis of a whole predictions directory, figures are rendered in parallel worker processes and a
+# manifest (figs/manifest.json) remembers which input produced which artifacts, so only new or changed prediction
+# files are processed again
+MANIFEST_FILE = 'figs/manifest.json'
+SUMMARY_FILE = 'figs/summary.csv'
+_ground_truth = None  # per worker process
+
+
+def prediction_files(path):
+    # a prediction pickle or all files of a prediction store
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, fn) for fn in os.listdir(path))
+    return [path]
+
+
+def file_fingerprint(path):
+    files = prediction_files(path)
+    return {'mtime': max(os.path.getmtime(f) for f in files), 'size': sum(os.path.getsize(f) for f in files)}
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    for fn in prediction_files(path):
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def init_analysis_worker():
+    global _ground_truth
+    plt.switch_backend('Agg')
+    _ground_truth = GroundTruth()
+
+
+def analyze_prediction(path):
+    # renders the figures and attention scores of one prediction file, returns its summary row and artifacts
+    labels_pred, meta = load_prediction_file(path)
+    labels_true = _ground_truth.get(meta.get('split_hash'), labels_pred.shape[0])
+    pred_vis = PredictionVisualization(labels_pred, labels_true, sort_after='race')
+
+    fn = os.path.splitext(os.path.basename(path))[0]
+    pred_vis.plot_gender_acc(normalize=True, fn=fn, override=True)
+    pred_vis.plot_gender_acc(normalize=False, fn=fn, override=True)
+    pred_vis.plot_histogram(fn=fn, override=True)
+    artifacts = [f'figs/plot_normalize_True_{fn}.png', f'figs/plot_normalize_False_{fn}.png',
+                 f'figs/histo_2d_{fn}.png', f'figs/histo_1d_{fn}.png',
+                 f'attention_scores/attention_scores_{fn}.json', f'attention_scores/attention_ci_{fn}.json']
+
+    confidence_intervals = pred_vis.stats.confidence_intervals(sort_after=pred_vis.sort_after)
+    with open(f'attention_scores/attention_ci_{fn}.json', 'w') as f:
+        json.dump(confidence_intervals, f)
+
+    group_accuracy = pred_vis.stats.group_accuracy(pred_vis.sort_after)
+    gap = confidence_intervals['accuracy_gap']
+    summary = {'split': meta.get('split'), 'split_hash': meta.get('split_hash'),
+               'n_samples': pred_vis.stats.n_samples, 'mean_accuracy': group_accuracy.mean(),
+               'min_accuracy': group_accuracy.min(), 'accuracy_gap': gap['estimate'],
+               'accuracy_gap_ci_low': gap['ci'][0], 'accuracy_gap_ci_high': gap['ci'][1],
+               'accuracy_gap_se': gap['se'], **dict(zip(pred_vis.class_names, group_accuracy.tolist()))}
+    for name, values in confidence_intervals['group_accuracy'].items():
+        summary[f'{name} ci_low'], summary[f'{name} ci_high'] = values['ci']
+    return summary, artifacts
+
+
+def write_manifest(manifest):
+    with open(MANIFEST_FILE + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(MANIFEST_FILE + '.tmp', MANIFEST_FILE)
+
+
+def analyze_predictions(pred_dir: str = 'predictions', n_jobs: int = None, force: bool = False):
+    os.makedirs('figs', exist_ok=True)
+    os.makedirs('attention_scores', exist_ok=True)
+    manifest = {}
+    if os.path.isfile(MANIFEST_FILE):
+        with open(MANIFEST_FILE) as f:
+            manifest = json.load(f)
+
+    runs = sorted(fn for fn in os.listdir(pred_dir) if fn.startswith('predictions') or fn.startswith('val_predictions'))
+    todo = {}
+    for fn in runs:
+        path = os.path.join(pred_dir, fn)
+        fingerprint = file_fingerprint(path)
+        entry = manifest.get(fn)
+        if not force and entry is not None and all(os.path.isfile(a) for a in entry['artifacts']):
+            if entry['mtime'] == fingerprint['mtime'] and entry['size'] == fingerprint['size']:
+                continue
+            # touched but unchanged files only get their new mtime recorded
+            fingerprint['sha1'] = file_hash(path)
+            if fingerprint['sha1'] == entry['sha1']:
+                manifest[fn] = {**entry, **fingerprint}
+                continue
+        todo[fn] = fingerprint
+    print(f'{len(todo)} of {len(runs)} prediction files to analyze')
+
+    if todo:
+        with ProcessPoolExecutor(n_jobs, initializer=init_analysis_worker) as pool:
+            futures = {pool.submit(analyze_prediction, os.path.join(pred_dir, fn)): fn for fn in todo}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                fn = futures[future]
+                try:
+                    summary, artifacts = future.result()
+                except Exception as e:
+                    print(f'Analysis of {fn} failed: {e}')
+                    continue
+                fingerprint = todo[fn]
+                if 'sha1' not in fingerprint:
+                    fingerprint['sha1'] = file_hash(os.path.join(pred_dir, fn))
+                manifest[fn] = {**fingerprint, 'artifacts': artifacts, 'summary': summary}
+                write_manifest(manifest)  # keep finished files when the run is interrupted
+
+    # forget removed prediction files and write one summary row per run
+    manifest = {fn: entry for fn, entry in manifest.items() if fn in runs}
+    write_manifest(manifest)
+    summary = pd.DataFrame([{'run': os.path.splitext(fn)[0], **entry['summary']} for fn, entry in manifest.items()])
+    summary.to_csv(SUMMARY_FILE, index=False)
+    return summary
 
-        pred_vis = PredictionVisualization(labels_pred, labels_true, sort_after='race')
-
-        fn = os.path.splitext(fn)[0]
-        # pred_vis.plot_gender_acc(normalize=True)
-        pred_vis.plot_gender_acc(normalize=True, fn=fn)
-        pred_vis.plot_gender_acc(normalize=False, fn=fn)
-        pred_vis.plot_histogram(fn=fn)
 
+if __name__ == "__main__":
+    # usage: python prediction_analysis.py [--jobs N] [--force]
+    n_jobs = int(sys.argv[sys.argv.index('--jobs') + 1]) if '--jobs' in sys.argv else None
+    analyze_predictions('predictions', n_jobs=n_jobs, force='--force' in sys.argv)
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+
+# A prediction store is a directory <name>.preds with
+#   meta.json      small header: config, timestamp, split, split_hash, head order, dtype, number of samples
+#   sample_id.npy  int64 position of every sample in the evaluated dataset (not its annotation file row when
+#                  balanced or indices subsets are used)
+#   <head>.npy     one contiguous (n_samples, n_classes) array per prediction head
+# All arrays are plain .npy files, so they can be memory-mapped on any device without unpickling tensors.
+STORE_SUFFIX = '.preds'
+
+
+def split_hash(files):
+    # identifies a split by the (ordered) list of image files it contains
+    return hashlib.sha1('\n'.join(files).encode()).hexdigest()
+
+
+class PredictionWriter:
+    # streams predictions batch by batch into a prediction store, the store only appears under its final name
+    # once close() has been called. The temporary directory is named after the writing process, so concurrent
+    # writers of the same store (e.g. parallel optuna trials) never write into each other's arrays, the last
+    # close() wins
+    def __init__(self, path, n_samples, head_sizes: dict, metadata: dict = None, dtype=np.float16):
+        self.path = path
+        self.tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        self.n_samples = n_samples
+        self.head_names = list(head_sizes)
+        self.metadata = dict(metadata or {})
+        self.dtype = np.dtype(dtype)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.arrays = {name: np.lib.format.open_memmap(os.path.join(self.tmp_path, name + '.npy'), mode='w+',
+                                                       dtype=self.dtype, shape=(n_samples, size))
+                       for name, size in head_sizes.items()}
+        self.sample_ids = np.lib.format.open_memmap(os.path.join(self.tmp_path, 'sample_id.npy'), mode='w+',
+                                                    dtype=np.int64, shape=(n_samples,))
+        self.offset = 0
+
+    def write(self, outputs, sample_ids=None):
+        # outputs: one array per head (in head order, or a dict keyed by head name); without sample_ids the
+        # samples are numbered in the order they are written
+        if not isinstance(outputs, dict):
+            outputs = dict(zip(self.head_names, outputs))
+        n = len(next(iter(outputs.values())))
+        for name, values in outputs.items():
+            self.arrays[name][self.offset:self.offset + n] = values
+        if sample_ids is None:
+            sample_ids = np.arange(self.offset, self.offset + n)
+        self.sample_ids[self.offset:self.offset + n] = sample_ids
+        self.offset += n
+
+    def close(self):
+        if self.offset != self.n_samples:
+            raise ValueError(f'Wrote {self.offset} samples into a store for {self.n_samples}')
+        for array in [*self.arrays.values(), self.sample_ids]:
+            array.flush()
+        meta = {**self.metadata, 'heads': self.head_names, 'dtype': self.dtype.name, 'n_samples': self.n_samples}
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        self.arrays, self.sample_ids = None, None
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.arrays, self.sample_ids = None, None
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def is_prediction_store(path):
+    return path.endswith(STORE_SUFFIX) and os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def load_predictions(path):
+    # returns (meta, {head: array}, sample_ids), the arrays are read-only memory maps
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    heads = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['heads']}
+    sample_ids = np.load(os.path.join(path, 'sample_id.npy'), mmap_mode='r')
+    return meta, heads, sample_ids
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import numpy as np
+import torch
+from torchvision.io import decode_image, ImageReadMode
+from torchvision.transforms.functional import resize
+from predict import load_model
+
+# Scoring server for FaceResNet checkpoints on localhost. Requests of all clients are gathered per model into
+# micro-batches of at most max_batch images, a batch is started when it is full or max_wait_ms after its first
+# request arrived, so one backbone pass serves many requests.
+#   POST /predict/<model>  body: encoded image (jpeg/png) -> {head: [probabilities]}
+#   GET  /models           names of the loaded models
+#   GET  /stats            latency and throughput counters per model
+#   POST /config           {"max_batch": n, "max_wait_ms": t}, changes the batching and resets the counters
+
+
+class ServerStats:
+    def __init__(self, window=10000):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=self.window)  # seconds from arrival to response, last requests
+        self.batch_sizes = collections.deque(maxlen=self.window)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        latencies = np.array(self.latencies) * 1000
+        return {'requests': self.requests, 'batches': self.batches, 'errors': self.errors,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.,
+                'throughput': self.requests / elapsed if elapsed > 0 else 0.,
+                'latency_ms': {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+                               'mean': float(latencies.mean())} if len(latencies) else {}}
+
+
+class MicroBatcher:
+    # queues single images of one model and runs them in batches on a dedicated thread
+    def __init__(self, model, device, max_batch=32, max_wait_ms=5.):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+        self.stats = ServerStats()
+        self.heads = model.output_heads()
+
+    async def predict(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    def run_batch(self, images):
+        with torch.inference_mode():
+            x = torch.stack(images).to(device=self.device, non_blocking=True).float() / 255
+            y_hat = self.model.to_probabilities(self.model(x))
+        if type(y_hat) is not tuple:
+            y_hat = (y_hat,)
+        return [el.float().cpu().numpy() for el in y_hat]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    # requests that arrived while the last batch ran are taken without waiting
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            images, futures = zip(*batch)
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.run_batch, list(images))
+            except Exception as e:
+                self.stats.errors += len(batch)
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.batches += 1
+            self.stats.batch_sizes.append(len(batch))
+            for i, future in enumerate(futures):
+                if not future.done():
+                    future.set_result({name: el[i].tolist() for name, el in zip(self.heads, outputs)})
+
+
+def decode(data, image_size=224):
+    image = decode_image(torch.frombuffer(bytearray(data), dtype=torch.uint8), mode=ImageReadMode.RGB)
+    if image.shape[1:] != (image_size, image_size):
+        image = resize(image, [image_size, image_size], antialias=True)
+    return image
+
+
+class ScoringServer:
+    def __init__(self, checkpoints, max_batch=32, max_wait_ms=5., n_decode_threads=4):
+        self.device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
+        self.checkpoints = checkpoints
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.decode_executor = ThreadPoolExecutor(n_decode_threads)
+        self.batchers = {}
+
+    def load(self):
+        # models are named after their checkpoint file
+        for checkpoint_path in self.checkpoints:
+            model, _ = load_model(checkpoint_path, self.device)
+            name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+            self.batchers[name] = MicroBatcher(model, self.device, self.max_batch, self.max_wait_ms)
+            print('Loaded ' + name + ' (' + ', '.join(self.batchers[name].heads) + ') on ' + self.device)
+
+    async def handle_request(self, method, path, body):
+        # returns (status, json response)
+        if method == 'GET' and path == '/models':
+            return 200, {name: batcher.heads for name, batcher in self.batchers.items()}
+        if method == 'GET' and path == '/stats':
+            return 200, {name: {'max_batch': batcher.max_batch, 'max_wait_ms': batcher.max_wait_ms,
+                                **batcher.stats.summary()} for name, batcher in self.batchers.items()}
+        if method == 'POST' and path == '/config':
+            config = json.loads(body or b'{}')
+            for batcher in self.batchers.values():
+                batcher.max_batch = int(config.get('max_batch', batcher.max_batch))
+                batcher.max_wait_ms = float(config.get('max_wait_ms', batcher.max_wait_ms))
+                batcher.stats.reset()
+            return 200, config
+        if method == 'POST' and path.startswith('/predict/'):
+            batcher = self.batchers.get(path[len('/predict/'):])
+            if batcher is None:
+                return 404, {'error': 'Unknown model ' + path[len('/predict/'):]}
+            arrival = time.perf_counter()
+            try:
+                image = await asyncio.get_running_loop().run_in_executor(self.decode_executor, decode, body)
+            except Exception as e:
+                batcher.stats.errors += 1
+                return 400, {'error': 'Cannot decode image: ' + str(e)}
+            result = await batcher.predict(image)
+            batcher.stats.requests += 1
+            batcher.stats.latencies.append(time.perf_counter() - arrival)
+            return 200, result
+        return 404, {'error': 'Unknown endpoint ' + method + ' ' + path}
+
+    async def handle_connection(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, _ = lines[0].split(' ', 2)
+                headers = {k.strip().lower(): v.strip() for k, v in (l.split(':', 1) for l in lines[1:] if ':' in l)}
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, response = await self.handle_request(method, urlsplit(target).path, body)
+                except Exception as e:
+                    status, response = 500, {'error': str(e)}
+                data = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                             % (status, b'OK' if status == 200 else b'Error', len(data)) + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        self.load()
+        tasks = [asyncio.create_task(batcher.run()) for batcher in self.batchers.values()]
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print('Serving on http://' + host + ':' + str(port))
+        async with server:
+            await server.serve_forever()
+        for task in tasks:
+            task.cancel()
+
+
+if __name__ == "__main__":
+    # usage: python serve.py <checkpoint.pt> [<checkpoint.pt> ...] [--port N] [--max-batch N] [--max-wait-ms T]
+    checkpoints = [arg for i, arg in enumerate(sys.argv[1:], 1) if not arg.startswith('--')
+                   and not sys.argv[i - 1].startswith('--')]
+    options = {sys.argv[i]: sys.argv[i + 1] for i in range(1, len(sys.argv) - 1) if sys.argv[i].startswith('--')}
+    server = ScoringServer(checkpoints, max_batch=int(options.get('--max-batch', 32)),
+                           max_wait_ms=float(options.get('--max-wait-ms', 5)))
+    asyncio.run(server.serve(port=int(options.get('--port', 8000))))
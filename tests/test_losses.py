@@ -0,0 +1,34 @@
+import pytest
+import torch
+from torch import nn
+from dlds_code import softmax_bce_from_logits, PenaltyWeightedBCELoss
+
+
+def test_softmax_bce_from_logits_matches_bce_on_probabilities():
+    torch.manual_seed(0)
+    logits = torch.randn(32, 7, dtype=torch.float64)
+    y = nn.functional.one_hot(torch.randint(0, 7, (32,)), 7).double()
+    expected = nn.functional.binary_cross_entropy(torch.softmax(logits, 1), y, reduction='none')
+    torch.testing.assert_close(softmax_bce_from_logits(logits, y).double(), expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('gap', [17., 40., 1000.])
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+def test_softmax_bce_from_logits_gradients_finite_for_large_logit_gap(gap, dtype):
+    # a confident head: one softmax probability rounds to 1
+    logits = torch.tensor([[gap, 0., -1.], [0., gap, 0.]], requires_grad=True)
+    y = torch.tensor([[1., 0., 0.], [1., 0., 0.]])
+    loss = softmax_bce_from_logits(logits.to(dtype), y).mean()
+    loss.backward()
+    assert torch.isfinite(loss)
+    assert torch.isfinite(logits.grad).all()
+
+
+def test_penalty_weighted_loss_from_logits_matches_probabilities():
+    torch.manual_seed(0)
+    logits = (torch.randn(16, 7), torch.randn(16, 2))
+    y = (nn.functional.one_hot(torch.randint(0, 7, (16,)), 7).float(),
+         nn.functional.one_hot(torch.randint(0, 2, (16,)), 2).float())
+    from_logits = PenaltyWeightedBCELoss(torch.ones(14), from_logits=True)(logits, y)
+    from_probabilities = PenaltyWeightedBCELoss(torch.ones(14))(tuple(torch.softmax(el, 1) for el in logits), y)
+    torch.testing.assert_close(from_logits, from_probabilities)